@@ -0,0 +1,179 @@
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+
+from utils import *
+
+import document
+from document import Document
+from editor import unansi
+
+USAGE = 'neptyne run [-j JOBS] [--timeout SECONDS] [--format json|text] [-o OUTPUT] [--no-cache] [--profile] FILES_OR_GLOBS...'
+
+
+def outputs(msgs):
+    return [dict(msg_type=m.get('msg_type'), data=m.get('data')) for m in map(document.resolve, msgs or [])]
+
+
+async def from_cache(filename, kernel, body):
+    # the outputs of all cells when every one of them is in the output
+    # cache, so that the file need not run again
+    cache = document.output_cache()
+    if not cache:
+        return None
+    codes = document.slices(body)
+    keys = document.prefix_keys(kernel, codes)
+    found = await cache.aget_many(keys)
+    if not all(key in found for key in keys):
+        return None
+    return [
+        dict(code=code, status='done', outputs=outputs(map(dotdict, found[key])))
+        for code, key in zip(codes, keys)
+    ]
+
+
+async def prepare(filename, use_cache):
+    # (result, body, kernel) of a file, where body is None when the result
+    # is already complete: the file could not be read or its outputs are
+    # all in the cache
+    result = dict(file=filename, ok=False, cached=False, timed_out=False, error=None, cells=[])
+    t = time.monotonic()
+    try:
+        body = open(filename, 'r').read()
+        kernel = document.kernel_from_filename(filename)
+    except Exception as e:
+        result.update(error=repr(e))
+        return result, None, None
+
+    cells = use_cache and await from_cache(filename, kernel, body)
+    if cells:
+        result.update(ok=True, cached=True, cells=cells, duration=time.monotonic() - t)
+        return result, None, None
+    return result, body, kernel
+
+
+async def run_file(result, body, kernel, timeout):
+    filename = result['file']
+    t = time.monotonic()
+    last = None
+    idle = asyncio.Event()
+
+    async def collect(_, state):
+        nonlocal last
+        last = state
+        # an error cancels the rest of the cells, which is not followed by
+        # a broadcast once the kernel reports it is done
+        if state.all and all(c.status in {'done', 'cancelled'} for c in state.all):
+            idle.set()
+
+    d = await Document(filename, [collect], kernel)
+    try:
+        d.new_body(body)
+        await asyncio.wait_for(idle.wait(), timeout)
+    except asyncio.TimeoutError:
+        result.update(timed_out=True)
+    finally:
+        await d.close(timeout=0.5 if result['timed_out'] else 5.0)
+
+    for c in last.all if last else []:
+        result['cells'].append(dict(code=c.code, status=c.status, timing=c.timing, outputs=outputs(c.msgs)))
+    errors = any(o['msg_type'] == 'error' for c in result['cells'] for o in c['outputs'])
+    result.update(ok=not errors and not result['timed_out'], duration=time.monotonic() - t)
+    return result
+
+
+def write_text(results, out):
+    for r in results:
+        flags = [k for k in ('cached', 'timed_out') if r[k]]
+        print(f"== {r['file']} {'ok' if r['ok'] else 'FAILED'} {' '.join(flags)}".rstrip(), file=out)
+        if r['error']:
+            print(r['error'], file=out)
+        for c in r['cells']:
+            for o in c['outputs']:
+                text = (o['data'] or {}).get('text/plain')
+                if text:
+                    print(unansi(text).rstrip('\n'), file=out)
+
+
+async def main(args):
+    jobs, timeout, format, output, use_cache = 4, 600.0, 'text', None, True
+    while args and args[0].startswith('-'):
+        two = len(args) >= 2
+        if two and args[0] == '-j':
+            jobs = int(args[1])
+            args = args[2:]
+        elif two and args[0] == '--timeout':
+            timeout = float(args[1])
+            args = args[2:]
+        elif two and args[0] == '--format' and args[1] in {'json', 'text'}:
+            format = args[1]
+            args = args[2:]
+        elif two and args[0] == '-o':
+            output = args[1]
+            args = args[2:]
+        elif args[0] == '--no-cache':
+            use_cache = False
+            args = args[1:]
+        elif args[0] == '--profile':
+            document.config.profile = True
+            args = args[1:]
+        else:
+            print(USAGE, file=sys.stderr)
+            return 2
+    files = expand(args)
+    if not files:
+        print(USAGE, file=sys.stderr)
+        return 2
+
+    # the outputs of the files that ran are kept for the next run, also
+    # with --no-cache, which only makes all files run again
+    document.config.output_cache = True
+
+    # files that cannot be read or are served from the cache need no kernel
+    prepared = await asyncio.gather(*(prepare(f, use_cache) for f in files))
+    kernels = [kernel for _, body, kernel in prepared if body is not None]
+
+    # kernels are kept started for the files that are to run next, up to
+    # jobs of them besides the ones running files, so that a file that
+    # gets a free slot need not wait for its kernel to start: the pool
+    # starts a replacement for each kernel a file takes, as long as there
+    # are files waiting, and the kernels of the next files are started
+    # when a file starts
+    document.config.kernel_pool = 0
+    document.config.kernel_pool_max = jobs
+    pool = document.kernel_pool()
+
+    def warm(start):
+        for kernel, n in Counter(kernels[start:start + jobs]).items():
+            pool.warm(kernel, n)
+
+    warm(0)
+    running = asyncio.Semaphore(jobs)
+    started = 0
+
+    async def run(result, body, kernel):
+        nonlocal started
+        if body is None:
+            return result
+        async with running:
+            started += 1
+            pool.size = min(jobs, len(kernels) - started)
+            warm(started)
+            return await run_file(result, body, kernel, timeout)
+
+    try:
+        results = await asyncio.gather(*(run(*p) for p in prepared))
+    finally:
+        await document.close_documents()
+
+    out = open(output, 'w') if output else sys.stdout
+    if format == 'json':
+        json.dump(results, out, indent=2, default=document.to_json)
+        print(file=out)
+    else:
+        write_text(results, out)
+    if output:
+        out.close()
+    return 0 if all(r['ok'] for r in results) else 1
@@ -0,0 +1,398 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+from time import perf_counter
+
+from utils import *
+
+import kernels
+import document
+from document import Document
+
+# Benchmarks of the execution pipeline on an in-process fake kernel, so
+# that they measure neptyne and not jupyter. Results are printed as json.
+#
+#   neptyne bench [-o FILE] [--clients N] [NAMES...]
+
+
+class FakeManager:
+    def __init__(self):
+        self._exit_future = asyncio.get_event_loop().create_future()
+
+    async def wait(self):
+        await asyncio.shield(self._exit_future)
+
+
+class FakeKernel:
+    # Stands in for a kernel client. Each line of a cell is one of
+    #   sleep SECONDS
+    #   stream COUNT [SIZE]
+    #   result TEXT
+    #   upper TEXT
+    #   error TEXT
+    # and anything else is echoed back as the result.
+
+    def __init__(self, m):
+        self.m = m
+        self.handlers = []
+        self.work = None
+        self.n = 0
+
+    def add_handler(self, fn, channel):
+        self.handlers.append((fn, channel))
+
+    def emit(self, channel, msg_type, content, parent):
+        msg = dotdict(header={'msg_type': msg_type}, parent_header={'msg_id': parent}, content=content)
+        for fn, ch in list(self.handlers):
+            if ch == channel:
+                fn(msg, channel)
+        return msg
+
+    def execute(self, code, silent=False, store_history=True, user_expressions=None, stop_on_error=True):
+        self.n += 1
+        return asyncio.ensure_future(self.run(code, f'fake-{self.n}'))
+
+    async def run(self, code, parent):
+        self.emit('iopub', 'status', {'execution_state': 'busy'}, parent)
+        self.work = asyncio.ensure_future(self.lines(code, parent))
+        try:
+            status = await self.work
+        except asyncio.CancelledError:
+            self.emit('iopub', 'error', dict(ename='KeyboardInterrupt', evalue='', traceback=['KeyboardInterrupt']), parent)
+            status = 'error'
+        self.work = None
+        self.emit('iopub', 'status', {'execution_state': 'idle'}, parent)
+        return self.emit('shell', 'execute_reply', {'status': status}, parent)
+
+    async def lines(self, code, parent):
+        for line in code.strip().split('\n'):
+            op, _, arg = line.strip().partition(' ')
+            if op == 'sleep':
+                await asyncio.sleep(float(arg))
+            elif op == 'stream':
+                count, _, size = arg.partition(' ')
+                text = 'x' * (int(size or 10) - 1) + '\n'
+                for i in range(int(count)):
+                    self.emit('iopub', 'stream', {'name': 'stdout', 'text': text}, parent)
+                    if i % 100 == 99:
+                        # let the loop run as if the messages came in batches
+                        await asyncio.sleep(0)
+            elif op == 'upper':
+                self.emit('iopub', 'execute_result', {'data': {'text/plain': arg.upper()}}, parent)
+            elif op == 'error':
+                self.emit('iopub', 'error', dict(ename='Error', evalue=arg, traceback=[arg]), parent)
+                return 'error'
+            elif line.strip():
+                self.emit('iopub', 'execute_result', {'data': {'text/plain': arg if op == 'result' else line}}, parent)
+        return 'ok'
+
+    async def interrupt(self):
+        if self.work:
+            self.work.cancel()
+
+    async def complete(self, code, cursor_pos=None):
+        return dotdict(content=dict(status='ok', matches=[], cursor_start=cursor_pos, cursor_end=cursor_pos))
+
+    async def inspect(self, code, cursor_pos=None, detail_level=0):
+        return dotdict(content=dict(status='ok', found=False, data={}))
+
+    async def is_alive(self):
+        return not self.m._exit_future.done()
+
+    async def shutdown_or_terminate(self, timeout=5.0):
+        if self.work:
+            self.work.cancel()
+        if not self.m._exit_future.done():
+            self.m._exit_future.set_result(0)
+
+    def close(self):
+        pass
+
+
+async def start_fake(name):
+    m = FakeManager()
+    return m, FakeKernel(m)
+
+
+def summary(times):
+    times = sorted(times)
+    ms = lambda t: round(t * 1000, 3)
+    return dict(
+        n=len(times),
+        mean_ms=ms(sum(times) / len(times)),
+        p50_ms=ms(times[len(times) // 2]),
+        p95_ms=ms(times[min(len(times) - 1, int(len(times) * 0.95))]),
+        max_ms=ms(times[-1]),
+    )
+
+
+def texts(state):
+    return [m.data.get('text/plain') for c in state.all for m in c.msgs if m.data]
+
+
+def watcher(predicate):
+    # a connection that sets the event once a state satisfies predicate
+    event = asyncio.Event()
+    async def connection(_, state):
+        if predicate(state):
+            event.set()
+    return event, connection
+
+
+async def bench_edit(rounds=100, cells=20):
+    # from new_body to the output of the edited last cell reaching subscribers
+    want = None
+    got, conn = watcher(lambda s: want in texts(s))
+    d = await Document('edit.fake', [conn], 'fake')
+    head = [f'result cell {i}' for i in range(cells - 1)]
+    times = []
+    for r in range(rounds):
+        want = f'edit {r}'
+        got.clear()
+        t = perf_counter()
+        d.new_body('\n\n'.join(head + [f'result {want}']))
+        await got.wait()
+        times.append(perf_counter() - t)
+    await d.close()
+    return summary(times)
+
+
+async def bench_interrupt(rounds=50):
+    # from new_body during a long running cell to the output of the new body
+    want = None
+    executing = asyncio.Event()
+    got, conn = watcher(lambda s: want in texts(s))
+    async def busy(_, state):
+        if any(c.status == 'executing' and c.code.startswith('sleep') for c in state.all):
+            executing.set()
+    d = await Document('interrupt.fake', [conn, busy], 'fake')
+    times = []
+    for r in range(rounds):
+        want = f'interrupted {r}'
+        executing.clear()
+        d.new_body(f'sleep 100\n\n# {r}')
+        await executing.wait()
+        # let the kernel report that it is busy, until then an interrupt
+        # is held back
+        await asyncio.sleep(0.01)
+        got.clear()
+        t = perf_counter()
+        d.new_body(f'result {want}')
+        await got.wait()
+        times.append(perf_counter() - t)
+    await d.close()
+    return summary(times)
+
+
+async def bench_stream(count=50000, size=80):
+    # stream messages per second from the kernel handler to subscribers
+    broadcasts = 0
+    last = None
+    def done(s):
+        nonlocal broadcasts, last
+        broadcasts += 1
+        last = s
+        return s.all and all(c.status == 'done' for c in s.all)
+    got, conn = watcher(done)
+    d = await Document('stream.fake', [conn], 'fake')
+    t = perf_counter()
+    d.new_body(f'stream {count} {size}')
+    await got.wait()
+    elapsed = perf_counter() - t
+    outputs = sum(len(c.msgs) for c in last.all)
+    await d.close()
+    return dict(
+        messages=count,
+        seconds=round(elapsed, 4),
+        messages_per_second=round(count / elapsed),
+        outputs_after_coalescing=outputs,
+        broadcasts=broadcasts)
+
+
+def encodes(server):
+    # messages encoded for and shared between websocket clients so far
+    count = sum(h[2] for h in server.encode_seconds.values.values())
+    return count, sum(server.encode_shared.values.values())
+
+
+async def bench_fanout(clients=10, count=5000, size=80, codec='json', compress=False):
+    # the same document streamed to websocket clients of the server. The
+    # clients run in this process too, so their receiving is counted.
+    import aiohttp
+    from aiohttp import web
+    import server
+
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    d = await Document('fanout.fake', server.connections, 'fake')
+    server.docs['fanout.fake'] = d
+
+    received = [dict(messages=0, bytes=0) for _ in range(clients)]
+
+    async def client(i, ready, finished):
+        async with aiohttp.ClientSession() as session:
+            url = f'http://127.0.0.1:{port}/ws'
+            async with session.ws_connect(url, max_msg_size=0, protocols=['neptyne.' + codec], compress=15 if compress else 0) as ws:
+                ready.set()
+                async for msg in ws:
+                    data = msg.data.encode() if isinstance(msg.data, str) else msg.data
+                    received[i]['messages'] += 1
+                    received[i]['bytes'] += len(data)
+                    if b'FANNED OUT' in data:
+                        finished.set()
+                        return
+
+    readies = [asyncio.Event() for _ in range(clients)]
+    finishes = [asyncio.Event() for _ in range(clients)]
+    tasks = [asyncio.create_task(client(i, readies[i], finishes[i])) for i in range(clients)]
+    for r in readies:
+        await r.wait()
+    encoded, shared = encodes(server)
+    t = perf_counter()
+    d.new_body(f'stream {count} {size}\nupper fanned out')
+    for f in finishes:
+        await f.wait()
+    elapsed = perf_counter() - t
+    await asyncio.gather(*tasks)
+    encoded, shared = [b - a for a, b in zip((encoded, shared), encodes(server))]
+    await d.close()
+    del server.docs['fanout.fake']
+    await runner.cleanup()
+    return dict(
+        clients=clients,
+        codec=codec,
+        compress=compress,
+        seconds=round(elapsed, 4),
+        encoded=encoded,
+        shared=shared,
+        messages_per_client=sum(r['messages'] for r in received) / clients,
+        bytes_per_client=sum(r['bytes'] for r in received) / clients)
+
+
+async def bench_memory(docs=20, edits=50):
+    # traced python memory per document after a long session of edits
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    open_docs = []
+    for i in range(docs):
+        got, conn = watcher(lambda s: s.all and all(c.status == 'done' for c in s.all))
+        open_docs.append((await Document(f'memory{i}.fake', [conn], 'fake'), got))
+    for e in range(edits):
+        for d, got in open_docs:
+            got.clear()
+            d.new_body(f'result {e}\n\nstream 20 80\n\nresult edit {e}')
+        for d, got in open_docs:
+            await got.wait()
+    used, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for d, _ in open_docs:
+        await d.close()
+    return dict(
+        docs=docs,
+        edits=edits,
+        bytes_per_doc=(used - before) // docs,
+        peak_bytes=peak - before)
+
+
+# Subcommands that editors run often, with their stdin, and the modules
+# they must not import because they make each run slow.
+QUICK = dict(kak_source='', request='type restart\nbufname bench.py\n')
+SLOW_IMPORTS = {'asyncio', 'aiohttp', 'aionotify', 'jupyter_kernel_mgmt', 'document', 'server'}
+
+
+async def run_quick(command, stdin, cwd, importtime=False):
+    # the wall time of a fresh interpreter running command, and the top
+    # level modules it imported if importtime
+    flags = ['-X', 'importtime'] if importtime else []
+    t = perf_counter()
+    p = await asyncio.create_subprocess_exec(
+        sys.executable, *flags, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'neptyne.py'), command,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE, cwd=cwd)
+    _, err = await p.communicate(stdin.encode())
+    elapsed = perf_counter() - t
+    modules = {
+        line.split('|')[-1].strip().split('.')[0]
+        for line in err.decode().splitlines()
+        if line.startswith('import time:')
+    }
+    return elapsed, modules
+
+
+async def bench_startup(rounds=20):
+    # the quick subcommands in a directory without a server, so requests
+    # go to its .requests
+    import tempfile
+    results = {}
+    with tempfile.TemporaryDirectory() as cwd:
+        for command, stdin in QUICK.items():
+            _, modules = await run_quick(command, stdin, cwd, importtime=True)
+            times = [(await run_quick(command, stdin, cwd))[0] for _ in range(rounds)]
+            results[command] = dict(
+                summary(times),
+                slow_imports=sorted(modules & SLOW_IMPORTS))
+    return results
+
+
+benches = dict(
+    edit=bench_edit,
+    interrupt=bench_interrupt,
+    stream=bench_stream,
+    fanout=bench_fanout,
+    memory=bench_memory,
+    startup=bench_startup,
+)
+
+
+async def main(args):
+    output, clients, names = None, 10, []
+    while args:
+        if len(args) >= 2 and args[0] == '-o':
+            output = args[1]
+            args = args[2:]
+        elif len(args) >= 2 and args[0] == '--clients':
+            clients = int(args[1])
+            args = args[2:]
+        elif args[0] in benches:
+            names.append(args[0])
+            args = args[1:]
+        else:
+            print('neptyne bench [-o FILE] [--clients N] [' + '|'.join(benches) + '...]', file=sys.stderr)
+            return 2
+
+    kernels.starters['fake'] = start_fake
+    document.config.output_cache = False
+    document.config.kernel_pool = 0
+
+    results = {}
+    for name in names or benches:
+        print('Running', name, file=sys.stderr)
+        if name == 'fanout':
+            # with each codec, and with permessage-deflate
+            import codec
+            variants = [(c, False) for c in codec.codecs] + [('json', True)]
+            results[name] = [await bench_fanout(clients, codec=c, compress=z) for c, z in variants]
+        else:
+            results[name] = await benches[name]()
+
+    report = dict(
+        python=sys.version.split()[0],
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        results=results)
+    out = open(output, 'w') if output else sys.stdout
+    json.dump(report, out, indent=2)
+    print(file=out)
+    if output:
+        out.close()
+    # a regression that makes every editor command slow
+    slow = [c for c, r in results.get('startup', {}).items() if r['slow_imports']]
+    if slow:
+        print('Imported too much:', ', '.join(slow), file=sys.stderr)
+        return 1
+    return 0
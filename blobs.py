@@ -0,0 +1,112 @@
+import os
+import json
+import base64
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import *
+
+# mime types whose values in mime bundles are base64 of binary data, which
+# is stored and served decoded
+BINARY = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+
+
+class BlobStore:
+    # Large values of mime bundles, in files named by the sha256 of their
+    # mime type and contents so that the same output is stored once and can
+    # be cached by viewers for good. A file is a json header line followed
+    # by the contents. The least recently used are removed when the files
+    # take up more than max_bytes. Worker processes share the directory.
+    # Blobs are written from a thread of their own, through aput, so that
+    # the event loop does not wait for the disk.
+
+    def __init__(self, dir, max_bytes):
+        os.makedirs(dir, exist_ok=True)
+        self.dir = dir
+        self.max_bytes = max_bytes
+        self.total = sum(size for _, size, _ in self.files())
+        self.thread = ThreadPoolExecutor(1, thread_name_prefix='blob-store')
+
+    def path(self, hash):
+        return os.path.join(self.dir, hash)
+
+    def files(self):
+        for name in os.listdir(self.dir):
+            if len(name) == 64:
+                try:
+                    st = os.stat(self.path(name))
+                except FileNotFoundError:
+                    continue
+                yield st.st_mtime, st.st_size, name
+
+    def put(self, mime, value):
+        # returns the reference that goes in place of value
+        if mime in BINARY and isinstance(value, str):
+            header, contents = dict(mime=mime, base64=True), base64.b64decode(value)
+        elif isinstance(value, str):
+            header, contents = dict(mime=mime), value.encode()
+        else:
+            header, contents = dict(mime=mime, json=True), json.dumps(value).encode()
+        data = json.dumps(header).encode() + b'\n' + contents
+        hash = hashlib.sha256(data).hexdigest()
+        path = self.path(hash)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            # a temporary file per writer, workers share the directory
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            try:
+                os.replace(tmp, path)
+            except OSError:
+                # another writer got there first with the same contents
+                if not os.path.exists(path):
+                    raise
+                os.remove(tmp)
+            else:
+                self.total += len(data)
+                if self.total > self.max_bytes:
+                    self.evict()
+        return dotdict(hash=hash, size=len(contents))
+
+    async def aput(self, mime, value):
+        return await asyncio.get_event_loop().run_in_executor(self.thread, self.put, mime, value)
+
+    def get(self, hash):
+        # (header, contents) or None when there is no such blob
+        if len(hash) != 64 or not all(c in '0123456789abcdef' for c in hash):
+            return None
+        try:
+            with open(self.path(hash), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        header, _, contents = data.partition(b'\n')
+        return dotdict(json.loads(header)), contents
+
+    def value(self, hash):
+        # the value as it was in the mime bundle, None when it is gone
+        blob = self.get(hash)
+        if blob is None:
+            return None
+        header, contents = blob
+        if header.base64:
+            return base64.b64encode(contents).decode()
+        if header.json:
+            return json.loads(contents)
+        return contents.decode()
+
+    def evict(self):
+        files = list(self.files())
+        self.total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if self.total <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            self.total -= size
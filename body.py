@@ -0,0 +1,96 @@
+from bisect import bisect_left, bisect_right
+
+
+class Body:
+    # The lines of a document and its cells as document.slices would split
+    # them, kept up to date by line range edits. Only the cells around an
+    # edit are split and joined again, the others keep their code strings,
+    # so that an edit costs about its own size plus the number of cells.
+    #
+    # A cell starts at a line that begins with non-whitespace, follows an
+    # empty line and has a non-empty line somewhere above it. The version is
+    # up to the editor, edits are only applied against the version they
+    # were made for.
+
+    def __init__(self, text='', version=None):
+        self.version = version
+        self.rescan(text.split('\n'))
+
+    def rescan(self, lines):
+        self.lines = lines
+        self.first = self.first_nonempty(0)
+        self.starts = [k for k in range(self.first + 1, len(lines)) if self.is_start(k)]
+        self.codes = [None] * (len(self.starts) + 1)
+
+    def first_nonempty(self, i):
+        while i < len(self.lines) and self.lines[i] == '':
+            i += 1
+        return i
+
+    def is_start(self, k):
+        line = self.lines[k]
+        return k > self.first and line[:1] != '' and not line[:1].isspace() and self.lines[k-1] == ''
+
+    def text(self):
+        return '\n'.join(self.lines)
+
+    def edit(self, start, end, new):
+        # replaces lines [start, end) with the list of lines new
+        lines, starts, codes = self.lines, self.starts, self.codes
+        assert 0 <= start <= end <= len(lines), (start, end, len(lines))
+        delta = len(new) - (end - start)
+        first = self.first
+        lines[start:end] = new
+        if start <= first:
+            self.first = self.first_nonempty(start)
+            if first >= end or self.first >= start + len(new):
+                # the first non-empty line moved across the edit, which
+                # can make or unmake cells anywhere below it
+                return self.rescan(lines)
+
+        # cells whose code may change: from the one with line start - 1 to
+        # the one after the one with line end, in old cell numbers
+        lo = bisect_right(starts, start - 1)
+        hi = bisect_right(starts, end) + 2
+
+        head = starts[:bisect_left(starts, start)]
+        window = [k for k in range(start, start + len(new) + 1) if k < len(lines) and self.is_start(k)]
+        tail = [k + delta for k in starts[bisect_right(starts, end):]]
+        self.starts = head + window + tail
+
+        kept = max(len(codes) - hi, 0)
+        self.codes = codes[:lo] + [None] * (len(self.starts) + 1 - lo - kept) + codes[len(codes) - kept:]
+
+    def replace(self, text):
+        # edits the lines between the common prefix and suffix, returns
+        # whether there were any
+        new = text.split('\n')
+        lines = self.lines
+        n = min(len(lines), len(new))
+        a = 0
+        while a < n and lines[a] == new[a]:
+            a += 1
+        b = 0
+        while b < n - a and lines[-1-b] == new[-1-b]:
+            b += 1
+        if a == len(lines) == len(new):
+            return False
+        self.edit(a, len(lines) - b, new[a:len(new) - b])
+        return True
+
+    def cells(self):
+        # the code of each cell, only joined again for cells an edit touched
+        starts, lines, codes = self.starts, self.lines, self.codes
+        for m, code in enumerate(codes):
+            if code is None:
+                begin = 0 if m == 0 else self.last_nonempty(starts[m-1]) + 1
+                end = len(lines) if m == len(starts) else self.last_nonempty(starts[m]) + 1
+                codes[m] = ('\n' if m else '') + '\n'.join(lines[begin:end])
+        return list(codes)
+
+    def last_nonempty(self, k):
+        # the last non-empty line above line k
+        k -= 1
+        while self.lines[k] == '':
+            k -= 1
+        return k
@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class OutputCache:
+    # Outputs of executed cells in sqlite, keyed by the prefix_keys hash of
+    # the cell. The least recently used are evicted when the outputs take
+    # up more than max_bytes. The database is used from a thread of its own,
+    # through the coroutines, so that the event loop does not wait for the
+    # disk. The total size is kept as the outputs come and go and counted
+    # again only to evict, since worker processes share the database.
+
+    def __init__(self, path, max_bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.max_bytes = max_bytes
+        self.thread = ThreadPoolExecutor(1, thread_name_prefix='output-cache')
+        with self.db:
+            self.db.execute('''
+                create table if not exists outputs (
+                    key text primary key,
+                    msgs text not null,
+                    size integer not null,
+                    used real not null
+                )''')
+            self.db.execute('create index if not exists outputs_used on outputs (used)')
+        self.total = self.count()
+
+    def count(self):
+        total, = self.db.execute('select coalesce(sum(size), 0) from outputs').fetchone()
+        return total
+
+    def get_many(self, keys):
+        # {key: msgs} of the keys that are in the cache
+        keys = list(set(keys))
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            for key, msgs in self.db.execute(f'select key, msgs from outputs where key in ({marks})', chunk):
+                found[key] = json.loads(msgs)
+        if found:
+            now = time.time()
+            with self.db:
+                self.db.executemany('update outputs set used = ? where key = ?', [(now, key) for key in found])
+        return found
+
+    def put(self, key, msgs):
+        data = json.dumps(list(msgs))
+        with self.db:
+            row = self.db.execute('select size from outputs where key = ?', (key,)).fetchone()
+            self.db.execute(
+                'insert or replace into outputs (key, msgs, size, used) values (?, ?, ?, ?)',
+                (key, data, len(data), time.time()))
+        self.total += len(data) - (row[0] if row else 0)
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # down to three quarters of max_bytes, so that it is not needed again
+        # for a while
+        total = self.count()
+        drop = []
+        for key, size in self.db.execute('select key, size from outputs order by used'):
+            if total <= self.max_bytes * 3 // 4:
+                break
+            drop.append((key,))
+            total -= size
+        with self.db:
+            self.db.executemany('delete from outputs where key = ?', drop)
+        self.total = total
+
+    async def aget_many(self, keys):
+        return await asyncio.get_event_loop().run_in_executor(self.thread, self.get_many, keys)
+
+    async def aput(self, key, msgs):
+        await asyncio.get_event_loop().run_in_executor(self.thread, self.put, key, msgs)
@@ -0,0 +1,136 @@
+import json
+import os
+import socket
+import struct
+
+from utils import *
+
+# Editor requests over a unix socket. Each message is a 4 byte big endian
+# length followed by a request in the .requests format, which may carry an
+# id line. Each is answered in the same framing with {"id": ..., "ok": ...}
+# as soon as it is queued. The client side is used by short lived editor
+# commands, so asyncio is only imported to serve.
+
+SOCKET = '.neptyne.sock'
+
+
+def parse_request(contents):
+    params = dotdict()
+    body = ''
+    lines = contents.split('\n')
+    for i, line in enumerate(lines):
+        if ' ' not in line:
+            continue
+        k, v = line.split(' ', 1)
+        if k == '---':
+            body = '\n'.join(lines[i+1:])
+            break
+        params[k] = v
+    params.body = body
+    for k, v in params.items():
+        if 'cursor_' in k:
+            params[k] = int(v)
+    return params
+
+
+def older(contents, prev):
+    # whether the request contents was made before the request prev
+    params, old = parse_request(contents), parse_request(prev)
+    if 'timestamp' not in params or 'timestamp' not in old:
+        return False
+    return int(params.timestamp) < int(old.timestamp)
+
+
+def as_edit(contents, prev):
+    # the process request contents as an edit request of the lines that
+    # changed since the process request prev, None when it cannot be one
+    params, old = parse_request(contents), parse_request(prev)
+    if params.type != 'process' or 'timestamp' not in params or 'timestamp' not in old:
+        return None
+    if params.bufname != old.bufname or 'full' in params.get('args', '').split():
+        return None
+    lines, new = old.body.split('\n'), params.body.split('\n')
+    n = min(len(lines), len(new))
+    a = 0
+    while a < n and lines[a] == new[a]:
+        a += 1
+    b = 0
+    while b < n - a and lines[-1-b] == new[-1-b]:
+        b += 1
+    edits = [[a, len(lines) - b, new[a:len(new) - b]]]
+    head = contents.split('\n--- ---\n', 1)[0].split('\n')
+    head = ['type edit' if line == 'type process' else line for line in head]
+    return '\n'.join(head + [f'base {old.timestamp}', '--- ---', json.dumps(edits)])
+
+
+def frame(data):
+    return struct.pack('>I', len(data)) + data
+
+
+async def read_frame(reader):
+    n, = struct.unpack('>I', await reader.readexactly(4))
+    return await reader.readexactly(n)
+
+
+async def serve(path, put):
+    import asyncio
+
+    # put gets the parsed requests in the order they arrive
+    async def connection(reader, writer):
+        try:
+            while True:
+                data = await read_frame(reader)
+                reply = dict(ok=True)
+                try:
+                    params = parse_request(data.decode())
+                    reply['id'] = params.get('id')
+                    put(params)
+                except Exception as e:
+                    reply.update(ok=False, error=repr(e))
+                writer.write(frame(json.dumps(reply).encode()))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        # left behind by a server that is gone, or in use by one that is not
+        try:
+            with socket.socket(socket.AF_UNIX) as s:
+                s.connect(path)
+            raise RuntimeError('Already serving requests on ' + path)
+        except ConnectionRefusedError:
+            os.remove(path)
+    return await asyncio.start_unix_server(connection, path)
+
+
+def recv_exactly(s, n):
+    data = b''
+    while len(data) < n:
+        chunk = s.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return data
+
+
+def send(path, contents, fallback='.requests', timeout=2.0):
+    # Blocking client for editors. Writes the request to the fallback file
+    # for the inotify watcher if it cannot be sent on the socket. Returns
+    # the reply, or None when none came in time: the request was sent, so
+    # it is not written to the fallback too.
+    with socket.socket(socket.AF_UNIX) as s:
+        s.settimeout(timeout)
+        try:
+            s.connect(path)
+            s.sendall(frame(contents.encode()))
+        except OSError:
+            with open(fallback, 'w') as f:
+                f.write(contents)
+            return None
+        try:
+            n, = struct.unpack('>I', recv_exactly(s, 4))
+            return json.loads(recv_exactly(s, n))
+        except OSError:
+            return None
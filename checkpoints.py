@@ -0,0 +1,120 @@
+import os
+
+# Runs in the kernel with path and limit bound. Pickles the user namespace,
+# or nothing if some value cannot be pickled or it gets larger than limit.
+SAVE = '''
+import os, types, pickle
+from IPython import get_ipython
+try:
+    import dill
+except ImportError:
+    dill = None
+
+def by_reference(v):
+    # plain pickle stores functions, classes and instances of classes from
+    # the notebook by name, which may mean something else on restore
+    t = v if isinstance(v, (type, types.FunctionType)) else type(v)
+    return getattr(t, '__module__', None) == '__main__'
+
+ip = get_ipython()
+modules, data, size = {}, {}, 0
+try:
+    for k, v in list(ip.user_ns.items()):
+        if k.startswith('_') or k in ip.user_ns_hidden:
+            continue
+        if isinstance(v, types.ModuleType):
+            modules[k] = v.__name__
+            continue
+        if dill is None and by_reference(v):
+            raise ValueError(k)
+        b = (dill or pickle).dumps(v)
+        size += len(b)
+        if size > limit:
+            raise ValueError(size)
+        data[k] = b
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump((modules, data), f)
+    os.replace(path + '.tmp', path)
+except BaseException:
+    if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+'''
+
+# Runs in the kernel with path bound. Replaces the user namespace with the
+# pickled one and sets _neptyne_restored to whether it succeeded.
+RESTORE = '''
+import importlib, pickle
+from IPython import get_ipython
+try:
+    import dill
+except ImportError:
+    dill = None
+
+ns = get_ipython().user_ns
+hidden = get_ipython().user_ns_hidden
+ns['_neptyne_restored'] = False
+try:
+    with open(path, 'rb') as f:
+        modules, data = pickle.load(f)
+    restored = {k: importlib.import_module(m) for k, m in modules.items()}
+    restored.update((k, (dill or pickle).loads(b)) for k, b in data.items())
+    for k in list(ns):
+        if not k.startswith('_') and k not in hidden and k not in restored:
+            del ns[k]
+    ns.update(restored)
+    ns['_neptyne_restored'] = True
+except Exception:
+    pass
+'''
+
+
+class Checkpoints:
+    # Snapshots of python kernel namespaces in a directory, one file per
+    # key. The least recently used are removed when it grows too large.
+
+    def __init__(self, dir, limit, max_bytes):
+        os.makedirs(dir, exist_ok=True)
+        self.dir = dir
+        self.limit = limit
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.dir, key + '.pickle')
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def drop(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    async def save(self, k, key):
+        code = f'exec({SAVE!r}, {{"path": {self.path(key)!r}, "limit": {self.limit!r}}})'
+        await k.execute(code, silent=True, store_history=False)
+        self.evict()
+
+    async def restore(self, k, key):
+        code = f'exec({RESTORE!r}, {{"path": {self.path(key)!r}}})'
+        reply = await k.execute(code, silent=True, store_history=False,
+                                user_expressions={'ok': '_neptyne_restored'})
+        ok = reply.content.get('user_expressions', {}).get('ok', {})
+        if ok.get('data', {}).get('text/plain') == 'True':
+            os.utime(self.path(key))
+            return True
+        self.drop(key)
+        return False
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.dir):
+            if name.endswith('.pickle'):
+                st = os.stat(os.path.join(self.dir, name))
+                files.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.dir, name))
+            total -= size
@@ -0,0 +1,47 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from document import to_json
+
+# Encodings of the messages to websocket clients, by the websocket
+# subprotocol that picks them. Clients that ask for none get json as text,
+# encoded with orjson when it is installed. msgpack frames are binary.
+
+PREFIX = 'neptyne.'
+
+
+def encode_json(obj):
+    if orjson:
+        try:
+            return orjson.dumps(obj, default=to_json).decode()
+        except TypeError:
+            # for example dict keys that are not strings
+            pass
+    return json.dumps(obj, default=to_json)
+
+
+def encode_msgpack(obj):
+    return msgpack.packb(obj, default=to_json, use_bin_type=True)
+
+
+codecs = dict(json=encode_json)
+if msgpack:
+    codecs['msgpack'] = encode_msgpack
+
+protocols = [PREFIX + name for name in codecs]
+
+
+def negotiated(protocol):
+    # the codec of a websocket subprotocol, json for none
+    if protocol and protocol.startswith(PREFIX) and protocol[len(PREFIX):] in codecs:
+        return protocol[len(PREFIX):]
+    return 'json'
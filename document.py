@@ -4,138 +4,859 @@ import jupyter_kernel_mgmt as jkm
 import asyncio
 
 import re
+import ast
+import os
+import hashlib
+import json
+import time
 from itertools import zip_longest
+from functools import lru_cache
+from difflib import SequenceMatcher
+from collections import deque, OrderedDict
+from collections.abc import Sequence
 
 from utils import *
+from checkpoints import Checkpoints
+from cache import OutputCache
+from spill import SpillStore
+from blobs import BlobStore
+from body import Body
+from editor import kak_complete, kak_inspect
+import introspect
+import profiling
+from fnmatch import fnmatch
+from kernels import KernelPool, Liveness, discover
+import metrics
 
 _documents = []
 
 async def close_documents():
-    for d in _documents:
+    for d in list(_documents):
         await d.close()
+    if _kernel_pool:
+        await _kernel_pool.close()
 
 next_id = id_stream()
 
-# new_body: str
-# prevs: [{code: str, id: str, status, msgs, prev_msgs}]
-# returns: [{code: str, id: str, status, msgs, prev_msgs}]
-# For now actually does not make any diff, just checks which cells are equal
-def diff_new_body(new_body, prevs):
+config = dotdict(
+    # adjacent stream output of a cell is merged for this many seconds or
+    # until it is this many bytes before it goes into the inbox
+    stream_window=env('stream_window', 0.05),
+    stream_bytes=env('stream_bytes', 64 * 1024),
+    # at most this many broadcasts per second and document for outputs of
+    # the executing cell, 0 to only broadcast when cells change status
+    broadcast_rate=env('broadcast_rate', 20.0),
+    # only reexecute changed python cells and the cells that use names they define
+    deps=env('deps', False),
+    # python only: pickle the namespace after cells that took at least
+    # checkpoint_after seconds, and restore the nearest one on edits and
+    # restarts instead of reexecuting from the top
+    checkpoint=env('checkpoint', False),
+    checkpoint_after=env('checkpoint_after', 1.0),
+    checkpoint_bytes=env('checkpoint_bytes', 256 * 2**20),
+    checkpoint_dir_bytes=env('checkpoint_dir_bytes', 2**30),
+    cache_dir=env('cache_dir', os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'neptyne')),
+    # outputs of executed cells are kept on disk and shown, marked stale,
+    # for cells with the same code prefix until they have executed again
+    output_cache=env('output_cache', False),
+    output_cache_bytes=env('output_cache_bytes', 64 * 2**20),
+    # kernels kept started per kernel name for documents to open and
+    # restart on, at most kernel_pool_max in total, shut down when their
+    # kernel name has not been used for kernel_pool_idle seconds
+    kernel_pool=env('kernel_pool', 1),
+    kernel_pool_max=env('kernel_pool_max', 4),
+    kernel_pool_idle=env('kernel_pool_idle', 600.0),
+    # kernel language by file extension, and (pattern, kernel name or
+    # language) pairs that are tried before it, first match wins
+    kernel_exts=dict(
+        py='python',
+        r='R',
+        lua='lua',
+        jl='julia',
+        go='go',
+        rb='ruby',
+    ),
+    kernels=[],
+    # seconds between checks of kernels whose process exit cannot be awaited
+    kernel_heartbeat=env('kernel_heartbeat', 1.0),
+    # completion and inspection requests are dropped when the kernel has
+    # not answered within this many seconds, and this many answers are
+    # kept per document until the next cell has executed
+    request_timeout=env('request_timeout', 2.0),
+    request_cache=env('request_cache', 64),
+    # python only: jedi answers too when the kernel is executing or has
+    # not answered within fallback_after seconds, the first answer wins
+    fallback=env('fallback', True),
+    fallback_after=env('fallback_after', 0.2),
+    # python only: profile cells with cProfile in the kernel and add the
+    # profile_top functions with the most own time to the outputs of cells
+    # that took at least profile_min seconds
+    profile=env('profile', False),
+    profile_top=env('profile_top', 10),
+    profile_min=env('profile_min', 0.1),
+    # outputs over these budgets, in bytes of their data, are spilled to
+    # disk oldest first and replaced by stubs that viewers fetch from
+    # /outputs/{id}: per message, per cell and per document, 0 for no
+    # limit. At most spill_bytes of spilled outputs are kept on disk.
+    output_msg_bytes=env('output_msg_bytes', 2**20),
+    output_cell_bytes=env('output_cell_bytes', 4 * 2**20),
+    output_document_bytes=env('output_document_bytes', 32 * 2**20),
+    spill_bytes=env('spill_bytes', 2**30),
+    # values of mime bundles of at least blob_min_bytes are kept in a blob
+    # store of at most blob_dir_bytes and served from /blobs/{hash}, 0 to
+    # keep them in the cell state
+    blob_min_bytes=env('blob_min_bytes', 16 * 1024),
+    blob_dir_bytes=env('blob_dir_bytes', 2**30),
+    # the number of printed messages stdout_connection remembers
+    stdout_seen=env('stdout_seen', 100000),
+)
+
+inbox_depth = metrics.Gauge('neptyne_inbox_depth', 'Messages waiting in the inbox of a document')
+iopub_messages = metrics.Counter('neptyne_iopub_messages_total', 'Messages from the iopub channel of kernels')
+edit_to_execute = metrics.Histogram('neptyne_edit_to_execute_seconds', 'Time from a new body to the start of its first scheduled cell')
+cell_seconds = metrics.Histogram('neptyne_cell_seconds', 'Execution time of cells')
+broadcast_seconds = metrics.Histogram('neptyne_broadcast_seconds', 'Time to hand a state of a document to its subscribers')
+kernel_restarts = metrics.Counter('neptyne_kernel_restarts_total', 'Kernels restarted after they died or were restarted on request')
+
+_kernel_pool = None
+
+def kernel_pool():
+    global _kernel_pool
+    if _kernel_pool is None:
+        _kernel_pool = KernelPool(
+            config.kernel_pool, config.kernel_pool_max, config.kernel_pool_idle,
+            in_use=lambda: {d.kernel for d in _documents})
+    return _kernel_pool
+
+_liveness = None
+
+def liveness():
+    global _liveness
+    if _liveness is None:
+        _liveness = Liveness(config.kernel_heartbeat)
+    return _liveness
+
+_output_cache = None
+
+def output_cache():
+    global _output_cache
+    if _output_cache is None and config.output_cache:
+        _output_cache = OutputCache(os.path.join(config.cache_dir, 'outputs.sqlite'), config.output_cache_bytes)
+    return _output_cache
+
+_spill_store = None
+
+def spill_store():
+    global _spill_store
+    if _spill_store is None:
+        _spill_store = SpillStore(os.path.join(config.cache_dir, 'spill'), config.spill_bytes)
+    return _spill_store
+
+_blob_store = None
+
+def blob_store():
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = BlobStore(os.path.join(config.cache_dir, 'blobs'), config.blob_dir_bytes)
+    return _blob_store
+
+
+class Msgs(Sequence):
+    # Read-only view of the first n messages of an append-only list, so that
+    # snapshots of a cell need not copy its outputs
+    __slots__ = ('buf', 'n')
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.n = len(buf)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.buf[j] for j in range(*i.indices(self.n))]
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        return self.buf[i]
+
+    def __repr__(self):
+        return repr(self[:])
+
+
+def to_json(x):
+    # default= for json.dumps to encode states which contain Msgs views
+    if isinstance(x, Msgs):
+        return x[:]
+    raise TypeError(f'{type(x).__name__} is not JSON serializable')
+
+
+class Cell:
+    # msgs is append-only while the cell executes and frozen after that,
+    # prev_msgs is the frozen msgs of the cell it replaced (or None), or
+    # outputs from the output cache in which case it is stale,
+    # key is the prefix_keys hash of the code up to and including this cell,
+    # timing is when it was queued, started and ended and how long it waited
+    # and executed, replaced rather than changed so snapshots can share it
+    __slots__ = ('code', 'id', 'status', 'msgs', 'prev_msgs', 'stale', 'key', 'timing', 'snap')
+
+    def __init__(self, code, id, status, msgs=None, prev_msgs=None):
+        self.code = code
+        self.id = id
+        self.status = status
+        self.msgs = [] if msgs is None else msgs
+        self.prev_msgs = prev_msgs
+        self.stale = False
+        self.key = None
+        self.timing = None
+        self.snap = None
+
+    def append(self, msg):
+        self.msgs.append(msg)
+        self.snap = None
+
+    def set(self, status, msgs=None, prev_msgs=False):
+        self.status = status
+        if msgs is not None:
+            self.msgs = msgs
+        if prev_msgs is not False:
+            self.prev_msgs = prev_msgs
+        self.snap = None
+
+    def time(self, **kws):
+        self.timing = dotdict(self.timing or {}, **kws)
+        self.snap = None
+
+    def snapshot(self):
+        if self.snap is None:
+            self.snap = dotdict(
+                code=self.code,
+                id=self.id,
+                status=self.status,
+                msgs=Msgs(self.msgs),
+                prev_msgs=None if self.prev_msgs is None else Msgs(self.prev_msgs),
+                stale=self.stale,
+                timing=self.timing,
+            )
+        return self.snap
+
+
+class Cells:
+    # The execution state of a document: all cells in the order of the
+    # document, the executing cell now and the cells scheduled to execute
+    # after it, all mutated in place
+    __slots__ = ('order', 'pos', 'now', 'scheduled')
+
+    def __init__(self, order=(), scheduled=()):
+        self.order = list(order)
+        self.pos = {c.id: i for i, c in enumerate(self.order)}
+        self.now = None
+        self.scheduled = deque(scheduled)
+        t = time.time()
+        for c in self.scheduled:
+            c.time(queued=t)
+
+    def start(self):
+        self.now = self.scheduled.popleft()
+        self.now.set('executing', msgs=[])
+        t = time.time()
+        self.now.time(started=t, wait=t - self.now.timing.queued)
+        return self.now
+
+    def end(self):
+        t = time.time()
+        self.now.time(ended=t, duration=t - self.now.timing.started)
+
+    def finish(self):
+        self.end()
+        self.now.set('done')
+        self.now = None
+
+    def retry(self):
+        # the executing cell goes back to the front of the schedule, the
+        # kernel did not execute it
+        self.now.set('scheduled', msgs=[])
+        self.scheduled.appendleft(self.now)
+        self.now = None
+
+    def cancel(self):
+        if self.now:
+            self.end()
+        for c in [self.now, *self.scheduled]:
+            if c:
+                c.set('cancelled', msgs=c.msgs or c.prev_msgs, prev_msgs=None)
+        self.now = None
+        self.scheduled.clear()
+
+    def snapshot(self):
+        return [c.snapshot() for c in self.order]
+
+def value_size(v):
+    return len(v) if isinstance(v, str) else len(json.dumps(v))
+
+
+def msg_size(msg):
+    # about the bytes of the data of a message, which the budgets count
+    if msg.spilled:
+        return 0
+    return sum(map(value_size, (msg.data or {}).values()))
+
+
+async def to_blobs(msg):
+    # moves the large values of the mime bundle of msg to the blob store,
+    # leaving {mime: {hash, size}} in blobs. text/plain stays, it is what
+    # the terminal and the viewer fall back on, and spills like the rest.
+    big = [
+        mime for mime, v in msg.data.items()
+        if mime != 'text/plain' and value_size(v) >= config.blob_min_bytes
+    ]
+    if not big:
+        return msg
+    data = dict(msg.data)
+    blobs = {}
+    for mime in big:
+        blobs[mime] = await blob_store().aput(mime, data.pop(mime))
+    return dotdict(msg, data=data, blobs=blobs)
+
+
+def spill(msg):
+    # moves msg to the spill store and returns the stub that is kept in its
+    # place, with the start of its text
+    spill_store().put(msg.id, json.dumps(msg, default=to_json).encode())
+    stub = dotdict((k, v) for k, v in msg.items() if k not in {'data', 'traceback'})
+    stub.spilled = msg_size(msg)
+    text = (msg.data or {}).get('text/plain')
+    stub.data = {'text/plain': text[:200]} if text else {}
+    return stub
+
+
+def spilled_output(id):
+    # the json of a spilled message, None if it is not spilled or gone
+    return _spill_store and _spill_store.get(id)
+
+
+def unspill(msg):
+    data = msg.spilled and spilled_output(msg.id)
+    return dotdict(json.loads(data)) if data else msg
+
+
+def resolve(msg):
+    # the whole of msg, with its spilled data and blobs back in place
+    msg = unspill(msg)
+    if not msg.blobs:
+        return msg
+    data = dict(msg.data)
+    for mime, blob in msg.blobs.items():
+        v = blob_store().value(blob['hash'])
+        if v is not None:
+            data[mime] = v
+    return dotdict({k: v for k, v in msg.items() if k != 'blobs'}, data=data)
+
+
+# cells: [Cell]
+# kinds: which outputs of the cells count, the outputs of their previous
+#        executions too by default
+# returns: the bytes of the outputs of the cells after spilling the oldest
+#          of them down to keep bytes, if they were more than budget
+def retain(cells, budget, keep, kinds=('prev_msgs', 'msgs')):
+    held = []
+    for c in cells:
+        for which in kinds:
+            for i, m in enumerate(getattr(c, which) or []):
+                n = msg_size(m)
+                if n:
+                    held.append((m.id, n, c, which, i))
+    total = sum(h[1] for h in held)
+    if total <= budget:
+        return total
+    spilled = {}
+    for _, n, c, which, i in sorted(held, key=lambda h: h[0]):
+        if total <= keep:
+            break
+        spilled.setdefault((c, which), []).append(i)
+        total -= n
+    # new lists, the old ones may be in snapshots
+    for (c, which), ixs in spilled.items():
+        msgs = list(getattr(c, which))
+        for i in ixs:
+            msgs[i] = spill(msgs[i])
+        if which == 'msgs':
+            c.set(c.status, msgs=msgs)
+        else:
+            c.set(c.status, prev_msgs=msgs)
+    return total
+
+
+@lru_cache(maxsize=4096)
+def trim(s):
+    if s:
+        return re.sub('\s*\n', '\n', re.sub('\#.*', '', s.strip()))
+    return s
 
-    def trim(s):
-        if s:
-            return re.sub('\s*\n', '\n', re.sub('\#.*', '', s.strip()))
-        return s
 
-    def slices(s):
-        return re.split(r'(?<=[^\n])(?=\n{2,}\S)', s)
+def slices(s):
+    return re.split(r'(?<=[^\n])(?=\n{2,}\S)', s)
 
-    def line_count(s):
-        return len(re.findall(r'\n', s))
 
-    new_codes = slices(new_body)
+# new_body: str, or its slices
+# prevs: [Cell]
+# deps: only reschedule changed cells and the cells that depend on them,
+#       otherwise everything after the first changed cell is rescheduled
+# returns: {cells: [Cell], scheduled: [Cell]}
+def diff_new_body(new_body, prevs, deps=False):
+
+    new_codes = slices(new_body) if isinstance(new_body, str) else new_body
+
+    if deps:
+        return diff_deps(new_codes, prevs)
 
     out = dotdict(
-        done = [],
+        cells = [],
         scheduled = []
     )
 
     changed = False
     for code, prev in zip_longest(new_codes, prevs):
         if code is not None:
-            me = dotdict(
-                code=code,
-                msgs=[],
-                id=next_id(),
-            )
-            if changed or (not prev or trim(prev.code) != trim(code) or prev.status == 'cancelled'):
+            if changed or (not prev or trim(prev.code) != trim(code) or prev.status != 'done'):
                 changed = True
-                me.status = 'scheduled'
-                if prev:
-                    if prev.status == 'done':
-                        me.prev_msgs = prev.msgs or []
-                    else:
-                        me.prev_msgs = prev.msgs or prev.prev_msgs or []
+                me = rescheduled(code, prev)
+                out.scheduled.append(me)
             else:
-                me.status = 'done'
-                if prev:
-                    me.msgs = prev.msgs
-                    me.prev_msgs = prev.prev_msgs
-            out[me.status].append(me)
+                # unchanged cells are kept as they are, also their id so
+                # that patches can refer to them
+                me = prev
+            out.cells.append(me)
 
     # pprint(dotdict(out, new_body=new_body))
 
     return out
 
 
-def kak_esc(msg):
-    return msg.replace('"', '""').replace('%', '%%')
+# returns: for each cell a hash of the kernel and the trimmed code of the
+#          cells up to and including it
+def prefix_keys(kernel, codes):
+    keys = []
+    key = kernel
+    for code in codes:
+        key = prefix_key(key, trim(code))
+        keys.append(key)
+    return keys
+
+
+@lru_cache(maxsize=4096)
+def prefix_key(prev, trimmed):
+    return hashlib.sha1(prev.encode() + b'\0' + trimmed.encode()).hexdigest()
+
+
+# d: {cells: [Cell], scheduled: [Cell]} from diff_new_body
+# clean: the number of cells whose execution the kernel state consists of,
+#        None if it is not known
+# returns: {cells, scheduled, restore, clean} where restore is the key of
+#          the checkpoint to restore before the first scheduled cell and
+#          clean is the number of cells the kernel state consists of then
+def plan_execution(d, clean, checkpoints, deps):
+    first = next((i for i, c in enumerate(d.cells) if c.status == 'scheduled'), len(d.cells))
+    if clean is not None and clean > first:
+        clean = None
+    restore = None
+    start = clean
+    if checkpoints and not (deps and clean is None):
+        for j in range(first, clean or 0, -1):
+            if checkpoints.has(d.cells[j-1].key):
+                restore = d.cells[j-1].key
+                start = j
+                break
+    if start is None:
+        return dotdict(d, restore=None, clean=None)
+    # the cells from start are reexecuted since the kernel has not seen them
+    cells = [
+        rescheduled(c.code, c) if i >= start and c.status == 'done' else c
+        for i, c in enumerate(d.cells)
+    ]
+    for c, prev in zip(cells, d.cells):
+        c.key = prev.key
+    return dotdict(
+        cells=cells,
+        scheduled=[c for c in cells if c.status == 'scheduled'],
+        restore=restore,
+        clean=start,
+    )
 
 
-def kak_send(msg, params):
-    from subprocess import Popen, PIPE
-    msg = f'eval -client {params.client} "{kak_esc(msg)}"'
-    p = Popen(['kak', '-p', str(params.session).rstrip()], stdin=PIPE)
-    p.stdin.write(msg.encode())
-    p.stdin.flush()
-    p.stdin.close()
-    p.wait()
+def rescheduled(code, prev):
+    me = Cell(code, next_id(), 'scheduled')
+    if prev:
+        if prev.status == 'done':
+            me.prev_msgs = prev.msgs
+        else:
+            me.prev_msgs = prev.msgs or prev.prev_msgs or []
+    return me
+
+
+# methods of the builtin containers that change them in place
+MUTATING_METHODS = {
+    'append', 'extend', 'insert', 'remove', 'pop', 'popitem', 'clear',
+    'update', 'setdefault', 'sort', 'reverse', 'add', 'discard',
+}
+
+
+class Names(ast.NodeVisitor):
+    # The names a python cell defines and reads. Assigning to or deleting
+    # an attribute or item of a name, or calling one of MUTATING_METHODS on
+    # it, counts as defining it since it mutates it. Other method calls, and
+    # passing it to a function, do not. Names read before they are defined
+    # in the cell, or mutated, are early: the cell builds on their values.
+    def __init__(self):
+        self.defines = set()
+        self.reads = set()
+        self.early = set()
+
+    def read(self, name):
+        self.reads.add(name)
+        if name not in self.defines:
+            self.early.add(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.read(node.id)
+        else:
+            self.defines.add(node.id)
+
+    def visit_Assign(self, node):
+        # the value is evaluated before the targets are assigned
+        self.visit(node.value)
+        for target in node.targets:
+            self.visit(target)
+
+    def visit_AnnAssign(self, node):
+        if node.value:
+            self.visit(node.value)
+        self.visit(node.target)
+
+    def visit_AugAssign(self, node):
+        self.visit(node.value)
+        if isinstance(node.target, ast.Name):
+            self.read(node.target.id)
+        self.visit(node.target)
+
+    def visit_def(self, node):
+        self.defines.add(node.name)
+        self.generic_visit(node)
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_ClassDef = visit_def
+
+    def visit_Import(self, node):
+        for a in node.names:
+            self.defines.add(a.asname or a.name.split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def mutates(self, node):
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        if isinstance(node, ast.Name):
+            self.read(node.id)
+            self.defines.add(node.id)
+
+    def visit_Attribute(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self.mutates(node)
+        self.generic_visit(node)
+
+    visit_Subscript = visit_Attribute
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute) and node.func.attr in MUTATING_METHODS:
+            self.mutates(node.func.value)
+        self.generic_visit(node)
+
+
+@lru_cache(maxsize=4096)
+def cell_names(code):
+    # (defines, reads, updates) of a python cell, None if it does not parse
+    # (for example because of IPython magics). updates are the names it
+    # defines from their values before it, like x += 1 does.
+    try:
+        tree = ast.parse(code.strip())
+    except SyntaxError:
+        return None
+    names = Names()
+    names.visit(tree)
+    return frozenset(names.defines), frozenset(names.reads), frozenset(names.defines & names.early)
+
+
+def diff_deps(new_codes, prevs):
+    # Cells are matched to done previous cells by their trimmed code, in
+    # order, so inserted and reordered cells do not reschedule the others.
+    # Unmatched cells are rescheduled and so are cells that read a name
+    # which a rescheduled cell or a removed cell defines, transitively. A
+    # rescheduled cell that updates a name runs on what the cells before it
+    # left in it, so the cells above it that define it are rescheduled too.
+
+    # cancelled cells get a key that never matches
+    prev_keys = [trim(prev.code) if prev.status == 'done' else prev for prev in prevs]
+    new_keys = [trim(code) for code in new_codes]
+
+    matches = [None] * len(new_codes)
+    for a, b, n in SequenceMatcher(None, prev_keys, new_keys, autojunk=False).get_matching_blocks():
+        for j in range(n):
+            matches[b + j] = a + j
+
+    # when cells are removed what they defined stays in the kernel, and
+    # which cells that affects is not known
+    matched = set(matches)
+    removed = [prev for i, prev in enumerate(prevs) if i not in matched and prev.status == 'done']
+    if len(removed) > matches.count(None):
+        return diff_new_body(new_codes, prevs)
+
+    names = [cell_names(code) for code in new_codes]
+    everything = object()
+
+    def schedule(forced):
+        dirty = set()
+
+        def touch(names):
+            if names is None:
+                dirty.add(everything)
+            else:
+                dirty.update(names[0])
 
+        for i, prev in enumerate(prevs):
+            if i not in matched:
+                touch(cell_names(prev.code))
 
-def kak_complete(params, reply):
-    line, column = params.cursor_line, params.cursor_column
-    content = dotdict(reply.content)
-    matches = content.matches
-    if not matches:
-        return
-    msgs = [f'"{kak_esc(m)}|neptyne-inspect menu|{kak_esc(m)}"' for m in matches]
-    dist = params.cursor_byte_offset - content.cursor_start
-    cmd = [f'set window neptyne_completions {line}.{column - dist}@{params.timestamp}']
-    msg = ' '.join(cmd + msgs)
-    kak_send(msg, params)
+        scheduled = []
+        for i, match in enumerate(matches):
+            if i in forced or match is None or everything in dirty or names[i] is None or dirty & names[i][1]:
+                scheduled.append(i)
+                touch(names[i])
+        return scheduled
+
+    def upstream(scheduled):
+        # the cells that define what the scheduled cells update, up to one
+        # that defines it from scratch
+        more = set()
+        for i in scheduled:
+            for name in names[i][2] if names[i] else ():
+                for j in range(i - 1, -1, -1):
+                    if names[j] is None or name in names[j][0]:
+                        more.add(j)
+                        if names[j] is not None and name not in names[j][2]:
+                            break
+        return more
+
+    forced = set()
+    while True:
+        scheduled = schedule(forced)
+        more = upstream(scheduled)
+        if more <= forced:
+            break
+        forced |= more
+
+    out = dotdict(
+        cells = [],
+        scheduled = []
+    )
 
+    scheduled = set(scheduled)
+    for i, (code, match) in enumerate(zip(new_codes, matches)):
+        if i in scheduled:
+            prev = prevs[match] if match is not None else prevs[i] if i < len(prevs) else None
+            me = rescheduled(code, prev)
+            out.scheduled.append(me)
+        else:
+            me = prevs[match]
+        out.cells.append(me)
 
-def unansi(msg):
-    ansi_escape = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
-    return ansi_escape.sub('', msg)
+    return out
 
 
-def kak_inspect(params, reply):
-    content = dotdict(reply.content)
-    if content.data and 'text/plain' in content.data:
-        txt = content.data['text/plain']
-        txt = unansi(txt)
-        style = ''
-        if params.args.split()[-1] == 'menu':
-            style = '-style menu'
-        print(params.args, style)
-        msg = f'info {style} "{kak_esc(txt)}"'
-        kak_send(msg, params)
+# sent: {order: [id], cells: {id: (status, n_msgs, last_msg, n_prev_msgs, last_prev_msg)}, ...},
+#       what the previous patch left the subscribers with, updated in place
+# cells: [{code: str, id: str, status, msgs, prev_msgs, timing}]
+# returns: {order?, add: [cell], remove: [id], changed: [{id, status?, msgs?, append?, prev_msgs?, timing?}]}
+#          or None when nothing has changed since the previous patch
+def cells_patch(sent, cells):
+    patch = dotdict(add=[], remove=[], changed=[])
+
+    order = [c.id for c in cells]
+    if order != sent.order:
+        patch.order = order
+
+    # lists of messages are replaced when outputs are spilled
+    buf = lambda msgs: getattr(msgs, 'buf', msgs)
+
+    seen = {}
+    for c in cells:
+        msgs = c.msgs or []
+        prev_msgs = c.prev_msgs or []
+        old = sent.cells.get(c.id)
+        if old is None:
+            patch.add.append(c)
+        else:
+            status, n, last, prev_n, prev_last, timing, msgs_buf, prev_buf = old
+            u = dotdict()
+            if c.status != status:
+                u.status = c.status
+            if c.timing is not timing:
+                u.timing = c.timing
+            if n and (len(msgs) < n or msgs[n-1] is not last or buf(msgs) is not msgs_buf):
+                u.msgs = msgs
+            elif len(msgs) > n:
+                u.append = msgs[n:]
+            if len(prev_msgs) != prev_n or prev_n and (prev_msgs[-1] is not prev_last or buf(prev_msgs) is not prev_buf):
+                u.prev_msgs = c.prev_msgs
+            if u:
+                patch.changed.append(dotdict(u, id=c.id))
+        seen[c.id] = (
+            c.status,
+            len(msgs), msgs[-1] if msgs else None,
+            len(prev_msgs), prev_msgs[-1] if prev_msgs else None,
+            c.timing,
+            buf(msgs), buf(prev_msgs),
+        )
+
+    patch.remove = [i for i in sent.cells if i not in seen]
+
+    sent.order = order
+    sent.cells = seen
+
+    if 'order' in patch or patch.add or patch.remove or patch.changed:
+        return patch
+
+
+def stream_coalescer(enqueue, window, max_bytes):
+    # Merges adjacent stream messages with the same parent request and
+    # stream name. Anything else must flush first to keep the order.
+    pending = None
+    timer = None
+
+    def flush():
+        nonlocal pending, timer
+        if timer:
+            timer.cancel()
+            timer = None
+        if pending:
+            p, pending = pending, None
+            enqueue(type='stream', data={'text/plain': ''.join(p.texts)}, stream=p.stream, msg_type='stream')
+
+    def push(parent, stream, text):
+        nonlocal pending, timer
+        if pending and (pending.parent != parent or pending.stream != stream):
+            flush()
+        if not pending:
+            pending = dotdict(parent=parent, stream=stream, texts=[], size=0)
+            if window > 0:
+                timer = asyncio.get_event_loop().call_later(window, flush)
+        pending.texts.append(text)
+        pending.size += len(text)
+        if pending.size >= max_bytes or window <= 0:
+            flush()
+
+    return dotdict(push=push, flush=flush)
+
+
+def request_lane(k, timeout, cache_size, fallback=None, fallback_after=0, busy=lambda: False):
+    # Completion and inspection requests, answered one at a time apart from
+    # the execution inbox. A request supersedes those of the same client
+    # and type that are waiting or in flight, unless its timestamp is older.
+    # Answers are cached by body hash, cursor offset and type. When the
+    # kernel is busy or slow the fallback is asked as well.
+    pending = {}
+    latest = {}
+    answers = OrderedDict()
+    wake = asyncio.Event()
+
+    def submit(params):
+        key = (params.client, params.type)
+        timestamp = int(params.get('timestamp') or 0)
+        if key in latest and timestamp < latest[key][0]:
+            return
+        latest[key] = timestamp, params
+        pending.pop(key, None)
+        pending[key] = params
+        wake.set()
+
+    async def run():
+        while True:
+            await wake.wait()
+            wake.clear()
+            while pending:
+                key = next(iter(pending))
+                params = pending.pop(key)
+                # one failing request, from the kernel or from kak, must not
+                # end the lane for the rest of the session
+                try:
+                    await answer(key, params)
+                except Exception as e:
+                    print('Could not answer', params.type, repr(e))
+
+    async def answer(key, params):
+        complete = params.type == 'complete'
+        cache_key = (hashlib.sha1(params.body.encode()).digest(), params.cursor_byte_offset, params.type)
+        reply = answers.get(cache_key)
+        if reply is None:
+            reply = await ask(params, complete)
+            if reply is None:
+                return
+            answers[cache_key] = reply
+            while len(answers) > cache_size:
+                answers.popitem(last=False)
+        else:
+            answers.move_to_end(cache_key)
+        if latest[key][1] is params:
+            (kak_complete if complete else kak_inspect)(params, reply)
+
+    async def ask(params, complete):
+        request = k.complete if complete else k.inspect
+        asking = [asyncio.ensure_future(request(params.body, params.cursor_byte_offset))]
+        try:
+            if fallback:
+                if not busy():
+                    done, _ = await asyncio.wait(asking, timeout=fallback_after)
+                    if done:
+                        return asking[0].result()
+                asking.append(asyncio.ensure_future(fallback(params, complete)))
+            for first in asyncio.as_completed(asking, timeout=timeout):
+                try:
+                    reply = await first
+                except asyncio.TimeoutError:
+                    return None
+                except Exception as e:
+                    print('Could not answer', params.type, repr(e))
+                    continue
+                if reply is not None:
+                    return reply
+        finally:
+            for f in asking:
+                f.cancel()
+
+    task = asyncio.create_task(run())
+
+    return dotdict(submit=submit, forget=answers.clear, close=task.cancel)
 
 
 def kernel_from_filename(filename):
-    exts = dict(
-        py='python',
-        r='R',
-        lua='lua',
-        jl='julia',
-        go='go',
-        rb='ruby',
-    )
-
-    KF = jkm.discovery.KernelFinder.from_entrypoints()
-    found_kernels = list(KF.find_kernels())
+    _, found_kernels = discover()
 
     known_str = (
         '\n\nKnown kernels:\n' + pformat(found_kernels) +
-        '\n\nKnown extensions: ' + pformat(exts)
+        '\n\nKnown extensions: ' + pformat(config.kernel_exts)
     )
 
     langname = None
-    for ext, lang in exts.items():
-        if filename.lower().endswith(ext):
-            langname = lang
+    for pattern, name in config.kernels:
+        if fnmatch(filename, pattern) or fnmatch(os.path.basename(filename), pattern):
+            if name in dict(found_kernels):
+                return name
+            langname = name
             break
+    else:
+        ext = os.path.splitext(filename)[1][1:].lower()
+        langname = config.kernel_exts.get(ext)
 
     if not langname:
         raise RuntimeError('Unknown kernel language for filename ' + filename + known_str)
@@ -157,74 +878,144 @@ async def Document(filename, connections, kernel=None):
     ID = IDs
     IDs += 1
 
-    active = await _Document(filename, connections, kernel, ID)
+    # what subscribers have been sent, kept across kernels so that the
+    # versions go on and the patches after a restart apply to what they have
+    sent = dotdict(version=0, order=[], cells={})
+
+    active = await _Document(filename, connections, kernel, ID, sent)
 
     self = dotdict()
 
     for f in active.keys():
         self[f] = (lambda f=f: lambda *args, **kws: active[f](*args, **kws))()
 
-    async def watcher():
+    def watch(a):
+        def died():
+            # stops its process loop, and brings up a new kernel unless
+            # the document was closed
+            a.inbox.put_nowait(dotdict(type='shutdown'))
+            a.lane.close()
+            if a is active and not a.closed:
+                asyncio.create_task(revive())
+        liveness().subscribe(a.m, a.k, died)
+
+    async def revive():
         nonlocal active
-        while True:
-            await asyncio.sleep(0.1)
-            y = await active.k.is_alive()
-            if active.closed:
-                return
-            if not y:
-                print(ID, 'Kernel has died, restarting')
-                last_body = active.last_body
-                active = await _Document(filename, connections, kernel, ID)
-                active.new_body(last_body)
+        print(ID, 'Kernel has died, restarting')
+        kernel_restarts.inc(kernel=kernel)
+        body = active.body
+        prevs = active.order()
+        active = await _Document(filename, connections, kernel, ID, sent, prevs)
+        watch(active)
+        active.new_body(body.text(), body.version)
 
-    asyncio.create_task(watcher())
+    watch(active)
 
     return self
 
 
-async def _Document(filename, connections, kernel, ID):
-    m, k = await jkm.start_kernel_async(kernel)
+async def _Document(filename, connections, kernel, ID, sent, prevs=()):
+    m, k = await kernel_pool().acquire(kernel)
+
+    # the cells of the previous kernel when restarting, they are all
+    # reexecuted except those covered by a checkpoint
+    cells = Cells(prevs)
+
+    def order():
+        return cells.order
 
     inbox = asyncio.Queue()
 
+    # dependency tracking, checkpoints, profiling and jedi are only used for python
+    python = filename.lower().endswith('.py')
+
+    if config.profile and python:
+        await profiling.install(k, config.profile_top, config.profile_min)
+
+    def fallback(params, complete):
+        answer = introspect.complete if complete else introspect.inspect
+        def run():
+            content = answer(params.body, params.cursor_byte_offset)
+            return content and dotdict(content=content)
+        return asyncio.get_event_loop().run_in_executor(None, run)
+
+    lane = request_lane(
+        k, config.request_timeout, config.request_cache,
+        fallback=config.fallback and python and introspect.jedi and fallback,
+        fallback_after=config.fallback_after,
+        busy=lambda: cells.now is not None)
+
     async def complete(**params):
-        inbox.put_nowait(dotdict(params))
+        lane.submit(dotdict(params))
 
     async def inspect(**params):
-        inbox.put_nowait(dotdict(params))
+        lane.submit(dotdict(params))
 
     async def restart(**_):
         await close(restart=True)
 
-    async def close(restart=False):
+    async def close(restart=False, timeout=5.0):
+        # a kernel that has not shut down after timeout seconds, for example
+        # because it is busy executing, is killed
         this.closed = not restart
         _documents.remove(this)
         inbox.put_nowait(dotdict(type='shutdown'))
-        await k.shutdown()
+        lane.close()
+        await k.shutdown_or_terminate(timeout)
         k.close()
+        # reaps the process, which would be left a zombie otherwise
         await m.wait()
 
     prio = 0
 
-    def new_body(body):
-        this.last_body = body
+    body = Body()
+
+    def new_body(text, version=None):
+        # a body older than the one here is from a request that was
+        # overtaken on its way
+        if version is not None and body.version is not None and version < body.version:
+            return
+        # a file saved as it is in the editor keeps the version the editor
+        # gave it, so that its next edits still apply
+        if body.replace(text) or version is not None:
+            body.version = version
+        changed()
+
+    def edit(edits, base, version=None):
+        # edits: [(start, end, [line])] against the lines at version base
+        if base != body.version:
+            raise ValueError(f'Edits are for version {base}, the body is at {body.version}')
+        for start, end, lines in edits:
+            body.edit(start, end, lines)
+        body.version = base + 1 if version is None else version
+        changed()
+
+    def changed():
         nonlocal prio
         prio += 1
-        inbox.put_nowait(dotdict(type='interrupt', new_body=body, prio=prio))
+        inbox.put_nowait(dotdict(type='interrupt', new_body=body.cells(), prio=prio, t=time.monotonic()))
 
     enqueue = lambda **kws: inbox.put_nowait(dotdict(kws))
 
+    stream = stream_coalescer(enqueue, config.stream_window, config.stream_bytes)
+
     def handler(msg, where):
         try:
             type = msg.header['msg_type']
             content = msg.content
+            iopub_messages.inc(type=type)
             # print(type, msg.content['execution_state'] if type == 'status' else '')
+            if where == 'iopub' and type == 'stream':
+                stream.push(msg.parent_header.get('msg_id'), content['name'], content['text'])
+                return
+            stream.flush()
             if where == 'iopub' and type == 'execute_result':
                 enqueue(type='data', data=content['data'], msg_type=type)
             elif where == 'iopub' and type == 'display_data':
-                enqueue(type='data', data=content['data'], msg_type=type)
-            elif where == 'iopub' and type == 'stream':
-                enqueue(type='stream', data={'text/plain': content['text']}, stream=content['name'], msg_type=type)
+                # profile summaries are told apart so that they are not
+                # taken for the display data of the cell
+                profile = profiling.MIME in content['data']
+                enqueue(type='data', data=content['data'], msg_type='profile' if profile else type)
             elif type == 'error':
                 enqueue(type='error', data={'text/plain': '\n'.join(content['traceback'])}, **content, msg_type=type)
             elif type == 'status':
@@ -246,6 +1037,7 @@ async def _Document(filename, connections, kernel, ID):
     def shell_handler(msg, *args, **kws):
         try:
             # print(msg)
+            stream.flush()
             if 'payload' in msg.content:
                 for p in msg.content['payload']:
                     enqueue(type='data', data=p['data'], msg_type='display_data')
@@ -261,44 +1053,97 @@ async def _Document(filename, connections, kernel, ID):
     def broadcast():
         inbox.put_nowait(dotdict(type='broadcast'))
 
+    async def executed(state, ok, aborted=False):
+        stream.flush()
+        await inbox.put(dotdict(type='execute_done', state=state, ok=ok, aborted=aborted))
+
+    async def execute(cell, restore, save, state):
+        if restore and not await checkpoints.restore(k, restore):
+            print(ID, 'Could not restore checkpoint, restarting')
+            await restart()
+            return
+        t = asyncio.get_event_loop().time()
+        with metrics.span('execute', ID, code=cell.code[:80]) as s:
+            # the cells after an error are cancelled here, the kernel need
+            # not abort what comes in after it
+            reply = await k.execute(cell.code, store_history=False, stop_on_error=False)
+        status = reply.content.get('status')
+        ok = status == 'ok'
+        cell_seconds.observe(s.dur, kernel=kernel)
+        if save and ok and asyncio.get_event_loop().time() - t >= config.checkpoint_after:
+            await checkpoints.save(k, cell.key)
+        await executed(state, ok, aborted=status == 'aborted')
+
+    deps = config.deps and python
+    checkpoints = config.checkpoint and python and Checkpoints(
+        os.path.join(config.cache_dir, 'checkpoints'),
+        config.checkpoint_bytes,
+        config.checkpoint_dir_bytes)
+
     async def process():
         self = dotdict()
         self.running = False
         self.interrupting = False
 
         self.new_body = None
-        self.done = []
-        self.now = None
-        self.scheduled = []
+        nonlocal cells
+
+        # the number of cells, counted from the top, whose execution is what
+        # the kernel state consists of, None when it is not known
+        self.clean = 0
+        self.restore = None
 
         self.body_prio = -1
 
         self.busy = False
 
+        # every broadcast carries a patch against the previous version so
+        # that subscribers which are up to date need not get the whole state
+        self.version = sent.version
+
+        loop = asyncio.get_event_loop()
+        last_broadcast = 0
+        broadcast_later = None
+
         async def broadcast():
-            all = self.done + ([self.now] if self.now else []) + self.scheduled
-            state = dotdict(self, all=all) # done=self.done, now=self.now, scheduled=self.scheduled, all=all)
-            for c in connections:
-                await c(filename, state)
+            nonlocal last_broadcast, broadcast_later
+            last_broadcast = loop.time()
+            if broadcast_later:
+                broadcast_later.cancel()
+                broadcast_later = None
+            all = cells.snapshot()
+            patch = cells_patch(sent, all)
+            if patch:
+                sent.version += 1
+                patch.base = sent.version - 1
+                patch.version = sent.version
+            self.version = sent.version
+            state = dotdict(self, all=all, patch=patch)
+            with metrics.span('broadcast', ID, version=self.version) as s:
+                for c in list(connections):
+                    await c(filename, state)
+            broadcast_seconds.observe(s.dur)
+
+        # when the body that is to be executed next was made, to time how
+        # long it takes until it starts executing
+        edited = None
+
+        # output bytes of the executing cell, and added to the document
+        # since its budget was last checked
+        now_bytes = 0
+        grown = 0
 
         while True:
             msg = await inbox.get()
+            inbox_depth.set(inbox.qsize(), document=filename)
             send_broadcast = False
+            send_outputs = False
             cancel_queue = False
             # pprint((ID, msg, self), compact=True)
             # print(ID, msg.type, self.max_interrupt, msg.prio, self.body_prio, self.finished)
-            if not await k.is_alive():
-                zapped_self = traverseKVs(self, lambda _k, v: v[:100] if isinstance(v, str) else v)
-                pprint(('not alive:', ID, msg, zapped_self, 'not alive'), compact=True)
-                return
             if msg.type == 'shutdown':
+                inbox_depth.remove(document=filename)
                 return
-            elif msg.type == 'complete':
-                reply = await k.complete(msg.body, msg.cursor_byte_offset)
-                kak_complete(msg, reply)
-            elif msg.type == 'inspect':
-                reply = await k.inspect(msg.body, msg.cursor_byte_offset)
-                kak_inspect(msg, reply)
             elif msg.type == 'broadcast':
                 send_broadcast = True
             elif msg.type == 'status':
@@ -308,6 +1153,7 @@ async def _Document(filename, connections, kernel, ID):
                     if not self.running and msg.prio > self.body_prio:
                         self.body_prio = msg.prio
                         self.new_body = msg.new_body
+                        edited = msg.t
                     elif self.running and msg.prio > self.body_prio:
                         self.interrupting = msg
                         # reschedule this in case kernel is not ready to be interrupted
@@ -321,11 +1167,24 @@ async def _Document(filename, connections, kernel, ID):
                                 inbox.put(dotdict(msg, rerun=True))))
                             # print(ID, 'too early to interrupt', msg.prio)
             elif msg.type == 'execute_done':
-                self.finished = self.now.id if self.now else self.finished
                 self.running = False
+                if msg.aborted:
+                    # still aborting after an error when the cell came in,
+                    # it executes again
+                    if cells.now:
+                        cells.retry()
+                        send_broadcast = True
+                else:
+                    self.finished = cells.now.id if cells.now else self.finished
+                    self.clean = self.clean + 1 if msg.ok and self.clean is not None else None
+                    # the namespace has changed, so may the answers
+                    lane.forget()
+                    if msg.ok and cells.now and output_cache():
+                        asyncio.create_task(output_cache().aput(cells.now.key, list(map(resolve, cells.now.msgs))))
                 if self.interrupting and self.interrupting.prio > self.body_prio:
                     self.body_prio = self.interrupting.prio
                     self.new_body = self.interrupting.new_body
+                    edited = self.interrupting.t
                     self.interrupting = False
                     cancel_queue = True
             elif msg.type in {'data', 'execute_result', 'stream', 'error'}:
@@ -339,52 +1198,90 @@ async def _Document(filename, connections, kernel, ID):
                 interrupted = msg.type == 'error' and msg.ename == 'KeyboardInterrupt'
                 msg.id = next_id()
                 if not interrupted:
-                    if not self.now:
+                    if not cells.now:
                         zapped_self = traverseKVs(self, lambda _k, v: v[:100] if isinstance(v, str) else v)
                         pprint(('detached message:', msg, zapped_self, 'detached_message'))
                     else:
-                        self.now = dotdict(self.now, msgs=[*self.now.msgs, msg])
+                        if msg.type == 'data' and config.blob_min_bytes:
+                            msg = await to_blobs(msg)
+                        size = msg_size(msg)
+                        if config.output_msg_bytes and size > config.output_msg_bytes:
+                            msg = spill(msg)
+                        cells.now.append(msg)
+                        send_outputs = True
+                        now_bytes += size
+                        grown += size
+                        if config.output_cell_bytes and now_bytes > config.output_cell_bytes:
+                            now_bytes = retain([cells.now], config.output_cell_bytes, config.output_cell_bytes // 2, kinds=('msgs',))
+                        budget = config.output_document_bytes
+                        if budget and grown > budget // 8:
+                            grown = 0
+                            retain(cells.order, budget, budget * 3 // 4)
                 if msg.type == 'error':
                     cancel_queue = True
 
             if cancel_queue:
-                cancelled = [
-                    dotdict(s, status='cancelled', msgs=s.msgs or s.prev_msgs, prev_msgs=None)
-                    for s in [self.now, *self.scheduled] if s
-                ]
-                self.done = [*self.done, *cancelled]
-                self.now = None
-                self.scheduled = []
+                cells.cancel()
                 send_broadcast = True
 
             if not self.running:
-                if self.new_body:
-                    d = diff_new_body(self.new_body, self.done)
-                    self.new_body = None
-                    self.done = d.done
-                    self.now = None
-                    self.scheduled = d.scheduled
+                if cells.now:
+                    cells.finish()
                     send_broadcast = True
 
-                if self.now:
-                    now = self.now
-                    self.now = None
-                    now = dotdict(now, status='done')
-                    self.done = [*self.done, now]
+                if self.new_body:
+                    d = diff_new_body(self.new_body, cells.order, deps=deps)
+                    for c, key in zip(d.cells, prefix_keys(kernel, [c.code for c in d.cells])):
+                        c.key = key
+                    clean = self.clean
+                    if clean is not None and d.cells[:clean] != cells.order[:clean]:
+                        clean = None
+                    d = plan_execution(d, clean, checkpoints, deps)
+                    if output_cache():
+                        found = await output_cache().aget_many([c.key for c in d.scheduled if not c.prev_msgs])
+                        for c in d.scheduled:
+                            cached = not c.prev_msgs and found.get(c.key)
+                            if cached:
+                                c.prev_msgs = [dotdict(m, id=next_id()) for m in cached]
+                                c.stale = True
+                    self.new_body = None
+                    if not d.scheduled:
+                        edited = None
+                    self.clean = d.clean
+                    self.restore = d.restore
+                    cells = Cells(d.cells, d.scheduled)
                     send_broadcast = True
 
-                if self.scheduled:
-                    assert self.now is None
-                    self.now, *self.scheduled = self.scheduled
-                    self.now = dotdict(self.now, status='executing', msgs=[])
-                    # print(ID, 'executing', repr(self.now.code), self.body_prio)
-                    asyncio.create_task(aseq(
-                        k.execute(self.now.code, store_history=False),
-                        inbox.put(dotdict(type='execute_done', state=dotdict(self)))))
+                if cells.scheduled:
+                    assert cells.now is None
+                    now = cells.start()
+                    now_bytes = 0
+                    if self.clean != cells.pos[now.id]:
+                        self.clean = None
+                    restore, self.restore = self.restore, None
+                    save = checkpoints and self.clean is not None
+                    # print(ID, 'executing', repr(now.code), self.body_prio)
+                    asyncio.create_task(execute(now, restore, save, dotdict(self)))
+                    if edited is not None:
+                        t = time.monotonic()
+                        edit_to_execute.observe(t - edited)
+                        metrics.record('edit to execute', edited, t - edited, ID)
+                        edited = None
                     self.running = True
+                    # busy is from the status messages of this execution on,
+                    # not the idle of the one before that may still be on
+                    # its way, so that it is not interrupted before it runs
+                    self.busy = False
                     send_broadcast = True
 
-            send_broadcast and await broadcast()
+            if send_broadcast:
+                await broadcast()
+            elif send_outputs and config.broadcast_rate > 0 and not broadcast_later:
+                wait = last_broadcast + 1 / config.broadcast_rate - loop.time()
+                if wait <= 0:
+                    await broadcast()
+                else:
+                    broadcast_later = loop.call_later(wait, inbox.put_nowait, dotdict(type='broadcast'))
 
     asyncio.create_task(process())
 
@@ -395,16 +1292,25 @@ async def _Document(filename, connections, kernel, ID):
 
     return this
 
-async def stdout_connection(filename, state, seen=set()):
+async def stdout_connection(filename, state, seen=OrderedDict()):
+    # seen: the ids of the latest config.stdout_seen printed cells and messages
+    def first(id):
+        if id in seen:
+            seen.move_to_end(id)
+            return False
+        seen[id] = None
+        if len(seen) > config.stdout_seen:
+            seen.popitem(last=False)
+        return True
+
     for d in state.all:
         for msg in d.msgs or []:
             if msg.data and 'text/plain' in msg.data:
-                if msg.id not in seen:
-                    if d.id not in seen:
-                        seen.add(d.id)
+                if first(msg.id):
+                    if first(d.id):
                         print()
-                    seen.add(msg.id)
-                    print(msg.data['text/plain'].rstrip())
+                    # the whole text, not the start that a spilled one keeps
+                    print(unspill(msg).data['text/plain'].rstrip())
 
 def output(state):
     # pprint(state)
@@ -421,6 +1327,8 @@ def assert_eq(a, b, obj=None):
 
 
 async def test_kernel():
+    # outputs cached by earlier runs would show up as prev_msgs
+    config.output_cache = False
     q = asyncio.Queue()
     async def c(filename, state):
         if state.running == False:
@@ -432,6 +1340,8 @@ async def test_kernel():
 
 
 async def test_kernel_with_all_finished():
+    # outputs cached by earlier runs would show up as prev_msgs
+    config.output_cache = False
     q = asyncio.Queue()
     last = None
     async def c(filename, state):
@@ -488,6 +1398,142 @@ async def test_keep():
     await d.close()
 
 
+async def test_edit():
+    q, d = await test_kernel()
+
+    d.new_body('x = 0; x\n\nx += 1; x\n\nx += 2; x', 1)
+    s = await q.get()
+    assert_eq(['0', '1', '3'], output(s))
+
+    d.edit([(4, 5, ['x += 3; x'])], 1)
+    s = await q.get()
+    assert_eq([          '3'], prev_output(s))
+    assert_eq(['0', '1', '6'], output(s))
+
+    d.edit([(2, 2, ['x *= 10; x', ''])], 2, 5)
+    s = await q.get()
+    assert_eq([     '1', '6'], prev_output(s))
+    assert_eq(['0', '60', '61', '64'], output(s))
+
+    # a save that leaves the body as it is keeps the version, and process
+    # requests go as edits of the lines that changed since the one before
+    import channel
+    body = 'x = 0; x\n\nx *= 10; x\n\nx += 1; x\n\nx += 3; x'
+    d.new_body(body)
+    s = await q.get()
+    assert_eq(['0', '60', '61', '64'], output(s))
+    request = lambda version, body: f'\ntype process\nbufname a.py\ntimestamp {version}\nargs \n--- ---\n{body}'
+    r = channel.parse_request(channel.as_edit(request(6, body.replace('3', '4')), request(5, body)))
+    assert_eq(('edit', '5', [[6, 7, ['x += 4; x']]]), (r.type, r.base, json.loads(r.body)))
+    d.edit(json.loads(r.body), int(r.base), int(r.timestamp))
+    s = await q.get()
+    assert_eq(['0', '60', '61', '68'], output(s))
+
+    await d.close()
+
+
+async def test_timing():
+    config.profile = True
+    config.profile_min = 0.0
+    q, d = await test_kernel()
+    config.profile = False
+
+    d.new_body('import time; time.sleep(0.2)\n\n1 + 1')
+    s = await q.get()
+    sleep, add = s.all
+    assert sleep.timing.queued <= sleep.timing.started <= sleep.timing.ended
+    assert sleep.timing.duration >= 0.2, sleep.timing
+    assert add.timing.wait >= 0.2, add.timing
+    profile = [m for m in sleep.msgs if m.msg_type == 'profile']
+    assert_eq(1, len(profile))
+    assert 'sleep' in profile[0].data['text/plain'], profile[0].data
+    assert_eq(['2'], [m.data['text/plain'] for m in add.msgs if m.msg_type == 'execute_result'])
+
+    await d.close()
+
+
+async def test_spill():
+    budgets = config.output_msg_bytes, config.output_cell_bytes
+    config.output_msg_bytes, config.output_cell_bytes = 1000, 3000
+    q, d = await test_kernel()
+
+    d.new_body('print("x" * 2000)\n\nfor i in range(8): display(str(i) * 500)')
+    s = await q.get()
+    big, many = s.all
+    assert_eq([2001], [m.spilled for m in big.msgs])
+    assert_eq(['x' * 2000], [unspill(m).data['text/plain'].strip() for m in big.msgs])
+    # the oldest are spilled down to half of the cell budget
+    assert_eq([True] * 4 + [None] * 4, [bool(m.spilled) or None for m in many.msgs])
+    assert_eq([repr(str(i) * 500) for i in range(8)], [unspill(m).data['text/plain'] for m in many.msgs])
+
+    # the outputs of the previous execution do not count for the new one
+    d.new_body('print("x" * 2000)\n\nfor i in range(7): display(str(i) * 500)')
+    s = await q.get()
+    _, many = s.all
+    assert_eq([True] * 4 + [None] * 3, [bool(m.spilled) or None for m in many.msgs])
+    assert_eq([True] * 4 + [None] * 4, [bool(m.spilled) or None for m in many.prev_msgs])
+
+    config.output_msg_bytes, config.output_cell_bytes = budgets
+    await d.close()
+
+
+async def test_blobs():
+    blob_min_bytes = config.blob_min_bytes
+    config.blob_min_bytes = 1000
+    q, d = await test_kernel()
+
+    html = '<b>' + 'x' * 2000 + '</b>'
+    d.new_body(f'from IPython.display import HTML\nHTML({html!r})')
+    s = await q.get()
+    msg, = s.all[0].msgs
+    assert_eq(['text/plain'], list(msg.data))
+    assert_eq(['text/html'], list(msg.blobs))
+    assert_eq(html, resolve(msg).data['text/html'])
+    assert_eq((dotdict(mime='text/html'), html.encode()), blob_store().get(msg.blobs['text/html'].hash))
+
+    config.blob_min_bytes = blob_min_bytes
+    await d.close()
+
+
+async def test_deps():
+    # a # in a string is not a comment, and plotting does not write plt
+    assert_eq((frozenset({'s'}), frozenset(), frozenset()), cell_names("s = '#' # s"))
+    assert_eq((frozenset({'xs'}), frozenset({'plt', 'xs'}), frozenset({'xs'})), cell_names('plt.plot(xs)\nxs.append(1)'))
+    # x is read after it is defined, and before in x += 1 and x = x + 1
+    assert_eq(frozenset(), cell_names('x = 1; x')[2])
+    assert_eq(frozenset({'x'}), cell_names('x += 1; x')[2])
+    assert_eq(frozenset({'x'}), cell_names('x = x + 1')[2])
+
+    # cells that are removed fall back to rescheduling all after them
+    prevs = [Cell(code, i, 'done') for i, code in enumerate(['a = 1', '\nb = 2', '\na'])]
+    d = diff_deps(['a = 1', '\na'], prevs)
+    assert_eq(['\na'], [c.code for c in d.scheduled])
+
+    config.deps = True
+    q, d = await test_kernel()
+
+    d.new_body('x = 1; x\n\ny = 2; y\n\nx + y')
+    assert_eq(['1', '2', '3'], output(await q.get()))
+
+    d.new_body('x = 3; x\n\ny = 2; y\n\nx + y')
+    s = await q.get()
+    assert_eq(['1',      '3'], prev_output(s))
+    assert_eq(['3', '2', '5'], output(s))
+
+    d.new_body('y = 2; y\n\nx = 3; x\n\nx + y')
+    s = await q.get()
+    assert_eq(['2', '3', '5'], output(s))
+
+    # a cell that updates x runs again from the cell that defines it
+    d.new_body('y = 2; y\n\nx = 3; x\n\nx += y; x')
+    assert_eq(['2', '3', '5'], output(await q.get()))
+    d.new_body('y = 2; y\n\nx = 3; x\n\nx += 2 * y; x')
+    assert_eq(['2', '3', '7'], output(await q.get()))
+
+    await d.close()
+    config.deps = False
+
+
 async def test_interrupt():
     q, d = await test_kernel()
     d.new_body('while True: print(len(list(range(10**6))))')
@@ -552,6 +1598,11 @@ async def test_prios():
 async def test():
     await test_abc()
     await test_keep()
+    await test_edit()
+    await test_timing()
+    await test_spill()
+    await test_blobs()
+    await test_deps()
     for i in range(5):
         await test_interrupt()
     for i in range(5):
@@ -0,0 +1,72 @@
+import asyncio
+import re
+from asyncio.subprocess import PIPE
+
+from utils import *
+
+
+def kak_esc(msg):
+    return msg.replace('"', '""').replace('%', '%%')
+
+
+# messages waiting to be sent per kak session and client, and the task
+# sending them per session
+_queued = {}
+_senders = {}
+
+def kak_send(msg, params):
+    # Queues msg for the client and returns at once. Messages that queue
+    # up while a session is being sent to go together in the next batch.
+    session = str(params.session).strip()
+    _queued.setdefault(session, {}).setdefault(params.client, []).append(msg)
+    if session not in _senders:
+        _senders[session] = asyncio.create_task(send_queued(session))
+
+
+async def send_queued(session):
+    try:
+        while _queued.get(session):
+            script = ''
+            for client, msgs in _queued.pop(session).items():
+                # each on its own, so that one that fails does not keep
+                # the rest of the batch from running
+                cmds = '\n'.join(f'try "{kak_esc(msg)}"' for msg in msgs)
+                script += f'eval -client {client} "{kak_esc(cmds)}"\n'
+            try:
+                p = await asyncio.create_subprocess_exec('kak', '-p', session, stdin=PIPE)
+                await p.communicate(script.encode())
+            except OSError as e:
+                print('Could not send to kak session', session, repr(e))
+    finally:
+        del _senders[session]
+
+
+def kak_complete(params, reply):
+    line, column = params.cursor_line, params.cursor_column
+    content = dotdict(reply.content)
+    matches = content.matches
+    if not matches:
+        return
+    msgs = [f'"{kak_esc(m)}|neptyne-inspect menu|{kak_esc(m)}"' for m in matches]
+    dist = params.cursor_byte_offset - content.cursor_start
+    cmd = [f'set window neptyne_completions {line}.{column - dist}@{params.timestamp}']
+    msg = ' '.join(cmd + msgs)
+    kak_send(msg, params)
+
+
+def unansi(msg):
+    ansi_escape = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
+    return ansi_escape.sub('', msg)
+
+
+def kak_inspect(params, reply):
+    content = dotdict(reply.content)
+    if content.data and 'text/plain' in content.data:
+        txt = content.data['text/plain']
+        txt = unansi(txt)
+        style = ''
+        if params.args.split()[-1] == 'menu':
+            style = '-style menu'
+        print(params.args, style)
+        msg = f'info {style} "{kak_esc(txt)}"'
+        kak_send(msg, params)
@@ -130,6 +130,12 @@ function activate(domdiff, root, websocket, state) {
       status_bar = span('ready', css`color: ${colors.green}`)
     }
 
+    const durations = state.cells.map(c => c.status == 'done' && c.timing && c.timing.duration || 0)
+    const slowest = durations.indexOf(Math.max(...durations))
+    if (durations[slowest] > 0) {
+      status_bar = span(status_bar, span(' slowest cell ', 1 + slowest, ' ', seconds(durations[slowest]), css`color: ${colors.grey60}`))
+    }
+
     const rix = (xs, f) => {
       const i = xs.slice().reverse().findIndex(f)
       if (i == -1) {
@@ -209,8 +215,90 @@ function activate(domdiff, root, websocket, state) {
 
   state.cells = state.cells || []
 
+  // filename -> {version, cells}, kept up to date by snapshots and patches
+  state.docs = state.docs || {}
+
+  // id -> outputs the server has spilled to disk, fetched when shown,
+  // null while they are being fetched
+  state.spilled = state.spilled || {}
+
+  // hash -> text of large outputs the server keeps as blobs, null while
+  // they are being fetched
+  state.blobs = state.blobs || {}
+
+  // images, base64 in mime bundles, which the server serves decoded
+  const IMAGES = ['image/png', 'image/jpeg', 'image/gif', 'image/webp']
+
+  function with_blobs(msg) {
+    // msg with its blobs in its mime bundle, images are linked to
+    const data = {...msg.data}
+    Object.entries(msg.blobs).forEach(([mime, blob]) => {
+      const url = `/blobs/${blob.hash}`
+      if (IMAGES.includes(mime)) {
+        data[mime] = {url}
+      } else if (state.blobs[blob.hash]) {
+        data[mime] = state.blobs[blob.hash]
+      } else if (!(blob.hash in state.blobs)) {
+        state.blobs[blob.hash] = null
+        fetch(url)
+          .then(r => r.ok ? r.text() : null)
+          .then(text => {
+            if (text !== null) {
+              state.blobs[blob.hash] = text
+              schedule_refresh()
+            }
+          })
+      }
+    })
+    return {...msg, data}
+  }
+
+  function fetch_spilled(msg) {
+    if (msg.id in state.spilled) {
+      return
+    }
+    state.spilled[msg.id] = null
+    fetch(`/outputs/${msg.id}?filename=${encodeURIComponent(state.filename)}`)
+      .then(r => r.ok ? r.json() : null)
+      .then(full => {
+        if (full) {
+          state.spilled[msg.id] = full
+          schedule_refresh()
+        }
+      })
+  }
+
+  function apply_patch(doc, patch) {
+    const by_id = {}
+    doc.cells.forEach(c => by_id[c.id] = c)
+    patch.remove.forEach(id => delete by_id[id])
+    patch.add.forEach(c => by_id[c.id] = c)
+    patch.changed.forEach(u => {
+      const c = by_id[u.id]
+      if ('status' in u) c.status = u.status
+      if ('msgs' in u) c.msgs = u.msgs
+      if ('append' in u) (c.msgs = c.msgs || []).push(...u.append)
+      if ('prev_msgs' in u) c.prev_msgs = u.prev_msgs
+      if ('timing' in u) c.timing = u.timing
+    })
+    if (patch.order) {
+      doc.cells = patch.order.map(id => by_id[id])
+    }
+    doc.version = patch.version
+  }
+
   function update_cell_data(msg) {
-    state.cells = msg
+    const doc = state.docs[msg.filename]
+    if (msg.type == 'snapshot') {
+      state.docs[msg.filename] = {version: msg.version, cells: msg.cells}
+    } else if (doc && doc.version == msg.base) {
+      apply_patch(doc, msg)
+    } else {
+      websocket.send(JSON.stringify({type: 'resync', filename: msg.filename}))
+      return
+    }
+    state.cells = state.docs[msg.filename].cells
+    state.filename = msg.filename
     // console.log(state.cells)
   }
 
@@ -239,6 +327,10 @@ function activate(domdiff, root, websocket, state) {
     }
   }
 
+  function seconds(s) {
+    return s < 1 ? Math.round(s * 1000) + 'ms' : s.toFixed(2) + 's'
+  }
+
   function cell_to_dom(cell) {
     const {status} = cell
     let msgs = prioritize_images(cell.msgs)
@@ -258,13 +350,21 @@ function activate(domdiff, root, websocket, state) {
     if (nothing_yet && status == 'executing') {
       grad_bottom = colours['scheduled']
     }
+    let stale = false
     if (prev_msgs.length > 0 && nothing_yet || status == 'cancelled') {
       msgs = prev_msgs
+      // outputs from the server's output cache of an earlier session
+      stale = cell.stale
     }
+    const timing = cell.timing && cell.timing.duration !== undefined && span(
+      seconds(cell.timing.duration),
+      css`float: right; font-size: 0.8em; color: ${colors.grey60};`)
     if (msgs.length) {
       return pre(
         // FlexColumnLeft,
+        timing,
         ...msgs.map(msg_to_dom),
+        stale && css`opacity: 0.6;`,
         // pre(css`display:none;color:white;font-size:0.8em`, JSON.stringify(cell, 2, 2)),
         grad_bottom
         ? css`
@@ -283,11 +383,19 @@ function activate(domdiff, root, websocket, state) {
 
   function msg_to_dom(msg) {
     // console.log(blob)
+    if (msg.spilled) {
+      // the start of its text until the whole of it has been fetched
+      fetch_spilled(msg)
+      msg = state.spilled[msg.id] || msg
+    }
+    if (msg.blobs) {
+      msg = with_blobs(msg)
+    }
     const mimes = msg.data
     if (mimes) {
       // console.log(mimes)
       const html = mimes['text/html'] || mimes['image/svg+xml']
-      const png = mimes['image/png']
+      const image = IMAGES.find(mime => mimes[mime])
       const plain = mimes['text/plain']
       if (html) {
         if (html.match(/<script /)) {
@@ -316,11 +424,11 @@ function activate(domdiff, root, websocket, state) {
           div.innerHTML = html.replace(/<table border="\d*"/g, '<table')
           return div
         }
-      } else if (png) {
+      } else if (image) {
         const img = document.createElement('img')
         img.style.background = 'white'
         img.foreign = true
-        img.src = 'data:image/png;base64,' + png
+        img.src = mimes[image].url || `data:${image};base64,` + mimes[image]
         return img
       } else if (plain) {
         return plain.replace(/\u001b\[[0-9;]*m/g, '')
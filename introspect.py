@@ -0,0 +1,36 @@
+try:
+    import jedi
+except ImportError:
+    jedi = None
+
+# Static completion and inspection of python code with jedi, for when the
+# kernel is too busy to answer. The replies look like the content of the
+# kernel's complete_reply and inspect_reply. Cursor offsets are in bytes,
+# like the ones the editor sends.
+
+
+def position(body, offset):
+    before = body.encode()[:offset].decode(errors='ignore')
+    line = before.count('\n') + 1
+    column = len(before) - before.rfind('\n') - 1
+    return before, line, column
+
+
+def complete(body, offset):
+    before, line, column = position(body, offset)
+    completions = jedi.Script(body).complete(line, column)
+    if not completions:
+        return None
+    matches = [c.name for c in completions]
+    typed = len(completions[0].name) - len(completions[0].complete)
+    start = offset - len(before[len(before) - typed:].encode()) if typed else offset
+    return dict(status='ok', matches=matches, cursor_start=start, cursor_end=offset, metadata={})
+
+
+def inspect(body, offset):
+    _, line, column = position(body, offset)
+    names = jedi.Script(body).help(line, column) or jedi.Script(body).help(line, max(column - 1, 0))
+    docs = [n.docstring() for n in names if n.docstring()]
+    if not docs:
+        return None
+    return dict(status='ok', found=True, data={'text/plain': docs[0]}, metadata={})
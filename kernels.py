@@ -0,0 +1,192 @@
+import jupyter_kernel_mgmt as jkm
+from jupyter_core.paths import jupyter_path
+import asyncio
+import time
+import os
+from collections import deque
+
+
+def spec_stamp():
+    # modification times of the kernelspec directories and files, which
+    # change when kernels are installed, removed or edited
+    stamp = []
+    for d in jupyter_path('kernels'):
+        try:
+            names = os.listdir(d)
+            stamp.append((d, os.stat(d).st_mtime_ns))
+        except OSError:
+            continue
+        for name in names:
+            try:
+                spec = os.path.join(d, name, 'kernel.json')
+                stamp.append((spec, os.stat(spec).st_mtime_ns))
+            except OSError:
+                pass
+    return stamp
+
+_discovery = None
+
+def discover():
+    # (finder, [(name, info)...]) of the installed kernels, only looked up
+    # again when the kernelspecs have changed
+    global _discovery
+    stamp = spec_stamp()
+    if _discovery is None or _discovery[0] != stamp:
+        finder = jkm.discovery.KernelFinder.from_entrypoints()
+        _discovery = stamp, finder, list(finder.find_kernels())
+    return _discovery[1:]
+
+# kernel name to an async function that starts it as (manager, client),
+# for kernels that are not found through the kernelspecs
+starters = {}
+
+async def start_kernel(name):
+    if name in starters:
+        return await starters[name](name)
+    finder, _ = discover()
+    return await jkm.start_kernel_async(name, finder=finder)
+
+
+async def shutdown(m, k):
+    try:
+        await k.shutdown_or_terminate()
+    except Exception as e:
+        print('Could not shut down kernel:', repr(e))
+    k.close()
+    await m.wait()
+
+
+class KernelPool:
+    # Started kernels waiting to be handed out, so that opening a document
+    # and restarting a dead or restarted kernel need not wait for a new
+    # kernel to start. Each kernel name used keeps size kernels ready, at
+    # most max_idle in total, until it has not been used for idle_timeout
+    # seconds. Names that in_use returns, those of open documents, are in
+    # use all along.
+
+    def __init__(self, size, max_idle, idle_timeout, start=None, in_use=None):
+        self.size = size
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.start = start or start_kernel
+        self.in_use = in_use or set
+        self.idle = {}
+        self.starting = {}
+        # the fill tasks of kernels that are starting
+        self.fills = set()
+        self.landed = {}
+        self.used = {}
+        self.reaper = None
+        self.closed = False
+
+    async def acquire(self, name):
+        self.used[name] = time.monotonic()
+        idle = self.idle.setdefault(name, deque())
+        try:
+            while True:
+                while idle:
+                    m, k = idle.popleft()
+                    if await k.is_alive():
+                        return m, k
+                    await shutdown(m, k)
+                if not self.starting.get(name):
+                    return await self.start(name)
+                # one is on its way: wait for it rather than start another
+                landed = self.landed.setdefault(name, asyncio.Event())
+                landed.clear()
+                await landed.wait()
+        finally:
+            self.refill(name)
+
+    def warm(self, name, n=1):
+        # start kernels ahead of the documents that are about to need them
+        self.used[name] = time.monotonic()
+        self.refill(name, max(n, self.size))
+
+    def refill(self, name, n=None):
+        if self.closed:
+            return
+        n = self.size if n is None else n
+        have = len(self.idle.get(name, ())) + self.starting.get(name, 0)
+        total = sum(map(len, self.idle.values())) + sum(self.starting.values())
+        for _ in range(min(n - have, self.max_idle - total)):
+            self.starting[name] = self.starting.get(name, 0) + 1
+            fill = asyncio.create_task(self.fill(name))
+            self.fills.add(fill)
+            fill.add_done_callback(self.fills.discard)
+        if self.reaper is None and self.idle_timeout > 0:
+            self.reaper = asyncio.create_task(self.reap())
+
+    async def fill(self, name):
+        try:
+            kernel = await self.start(name)
+        except Exception as e:
+            print('Could not start kernel', name, repr(e))
+            kernel = None
+        finally:
+            self.starting[name] -= 1
+        if kernel and self.closed:
+            await shutdown(*kernel)
+        elif kernel:
+            self.idle.setdefault(name, deque()).append(kernel)
+        if name in self.landed:
+            self.landed[name].set()
+
+    async def reap(self):
+        while not self.closed:
+            await asyncio.sleep(max(self.idle_timeout / 4, 1))
+            # acquire and refill change self.idle while kernels shut down,
+            # and a name may be used again meanwhile, so each kernel is
+            # checked again
+            now = time.monotonic()
+            for name in self.in_use():
+                self.used[name] = now
+            for name, idle in list(self.idle.items()):
+                while idle and name in self.used and time.monotonic() - self.used[name] > self.idle_timeout:
+                    await shutdown(*idle.popleft())
+
+    async def close(self):
+        self.closed = True
+        if self.reaper:
+            self.reaper.cancel()
+        # kernels that are starting are shut down once they have started,
+        # a start that is cancelled halfway leaves its kernel behind
+        await asyncio.gather(*self.fills, return_exceptions=True)
+        for idle in list(self.idle.values()):
+            while idle:
+                await shutdown(*idle.popleft())
+
+
+class Liveness:
+    # Calls back when kernels die. Each kernel is watched through the wait
+    # of its manager, which returns when its process exits. Kernels whose
+    # manager cannot wait for them are polled together by one heartbeat
+    # task every interval seconds.
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.polled = {}
+        self.heartbeat = None
+
+    def subscribe(self, m, k, died):
+        asyncio.create_task(self.wait(m, k, died))
+
+    async def wait(self, m, k, died):
+        try:
+            await m.wait()
+        except Exception as e:
+            print('Cannot wait for kernel, polling it instead:', repr(e))
+            self.polled[k] = died
+            if self.heartbeat is None:
+                self.heartbeat = asyncio.create_task(self.beat())
+            return
+        died()
+
+    async def beat(self):
+        while self.polled:
+            await asyncio.sleep(self.interval)
+            for k, died in list(self.polled.items()):
+                if not await k.is_alive():
+                    del self.polled[k]
+                    died()
+        self.heartbeat = None
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import atexit
+from bisect import bisect_left
+from collections import deque
+
+from utils import *
+
+# Counters, gauges and histograms of this process, served in the prometheus
+# text format at /metrics, and trace spans that are kept while tracing is
+# on and written as chrome trace events (chrome://tracing, perfetto) when
+# the process exits. Labels are given as keywords where values are set.
+
+config = dotdict(
+    # file that trace spans are written to on exit, empty to not trace
+    trace=env('trace', ''),
+    # at most this many of the latest spans are kept
+    trace_spans=env('trace_spans', 100000),
+)
+
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics = {}
+
+
+def key(labels):
+    # label values are strings in the exposition, and must sort
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def fmt_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+
+class Metric:
+    def __init__(self, name, help, type):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.values = {}
+        _metrics[name] = self
+
+    def remove(self, **labels):
+        self.values.pop(key(labels), None)
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        for labels, v in sorted(self.values.items()):
+            yield f'{self.name}{fmt_labels(labels)} {v}'
+
+
+class Counter(Metric):
+    def __init__(self, name, help):
+        super().__init__(name, help, 'counter')
+
+    def inc(self, n=1, **labels):
+        k = key(labels)
+        self.values[k] = self.values.get(k, 0) + n
+
+
+class Gauge(Metric):
+    def __init__(self, name, help):
+        super().__init__(name, help, 'gauge')
+
+    def set(self, v, **labels):
+        self.values[key(labels)] = v
+
+    def inc(self, n=1, **labels):
+        k = key(labels)
+        self.values[k] = self.values.get(k, 0) + n
+
+
+class Histogram(Metric):
+    # values are [count per bucket, sum, count], the buckets are made
+    # cumulative when written
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super().__init__(name, help, 'histogram')
+        self.buckets = buckets
+
+    def observe(self, v, **labels):
+        k = key(labels)
+        h = self.values.get(k)
+        if h is None:
+            h = self.values[k] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        h[0][bisect_left(self.buckets, v)] += 1
+        h[1] += v
+        h[2] += 1
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        for labels, (counts, total, n) in sorted(self.values.items()):
+            acc = 0
+            for le, c in zip(list(self.buckets) + ['+Inf'], counts):
+                acc += c
+                yield f'{self.name}_bucket{fmt_labels(labels, [("le", le)])} {acc}'
+            yield f'{self.name}_sum{fmt_labels(labels)} {total}'
+            yield f'{self.name}_count{fmt_labels(labels)} {n}'
+
+
+def render():
+    return '\n'.join(line for m in _metrics.values() for line in m.lines()) + '\n'
+
+
+_spans = None
+_t0 = time.monotonic()
+
+
+def tracing():
+    global _spans
+    if config.trace and _spans is None:
+        _spans = deque(maxlen=config.trace_spans)
+        atexit.register(dump)
+    return _spans is not None
+
+
+def record(name, t, dur, tid=0, **args):
+    # a span that started at monotonic time t and took dur seconds
+    if tracing():
+        event = dict(name=name, ph='X', pid=os.getpid(), tid=tid,
+                     ts=round((t - _t0) * 1e6), dur=round(dur * 1e6))
+        if args:
+            event['args'] = args
+        _spans.append(event)
+
+
+class span:
+    # with span(name, **args): records the time the block took, tid groups
+    # the spans into rows, for example one per document
+
+    def __init__(self, name, tid=0, **args):
+        self.name = name
+        self.tid = tid
+        self.args = args
+
+    def __enter__(self):
+        self.t = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.dur = time.monotonic() - self.t
+        record(self.name, self.t, self.dur, self.tid, **self.args)
+        return False
+
+
+def dump(path=None):
+    path = path or config.trace
+    if path and _spans is not None:
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=list(_spans), displayTimeUnit='ms'), f, default=str)
@@ -1,237 +1,103 @@
-from pprint import pprint, pformat
-
-import jupyter_kernel_mgmt as jkm
-
-import asyncio
-import aionotify
-import aiohttp
-from aiohttp import web
-
 import os
-
-from utils import *
-
-import document
-from document import Document
-
-connections = []
-
-docs = {}
-
-async def watch(connections, initial_files=[]):
-
-    assert not docs, 'Watch already started'
-
-    async def doc(filename):
-        if filename not in docs:
-            docs[filename] = await Document(filename, connections)
-        return docs[filename]
-
-    async def do(filename, body):
-        d = await doc(filename)
-        d.new_body(body)
-
-    for filename in initial_files:
-        await do(filename, open(filename, 'r').read())
-
-    watcher = aionotify.Watcher()
-    watcher.watch(path='.', flags=aionotify.Flags.CLOSE_WRITE)
-    loop = asyncio.get_event_loop()
-    await watcher.setup(asyncio.get_event_loop())
-    while True:
-        event = await watcher.get_event()
-        # print('event:', event)
-        filename = event.name
-        if filename in initial_files:
-            body = open(filename, 'r').read()
-            await do(filename, body)
-        if filename == '.requests':
-            contents = open('.requests', 'r').read()
-            params = dotdict()
-            lines = contents.split('\n')
-            for i, line in enumerate(lines):
-                if ' ' not in line:
-                    continue
-                k, v = line.split(' ', 1)
-                if k == '---':
-                    body = '\n'.join(lines[i+1:])
-                    break
-                params[k] = v
-            params.body = body
-            for k, v in params.items():
-                if 'cursor_' in k:
-                    params[k] = int(v)
-            # print(pformat(params))
-            if params.type == 'process':
-                await do(params.bufname, body)
-            elif params.type in {'restart', 'complete', 'inspect'}:
-                d = await doc(params.bufname)
-                await d[params.type](**params)
-            else:
-                print('Unknown request:', pformat(params))
-
-app = web.Application()
-routes = web.RouteTableDef()
-
-@routes.get('/ws')
-async def websocket_connection(request):
-    websocket = web.WebSocketResponse()
-    await websocket.prepare(request)
-
-    q = asyncio.Queue()
-
-    async def fwd(filename, state):
-        await q.put((filename, state))
-
-    connections.append(fwd)
-    for _, d in docs.items():
-        d.broadcast()
-
-
-    sent = set()
-
-    while True:
-        filename, state = await q.get()
-        await websocket.send_json(state.all)
-
-    return websocket
-
-def track(url):
-    url = repr(url)
-    track="""
-        "use strict";
-        {
-          let i = 0
-          const reimported = {}
-          const sloppy = s => s.replace(/.*\//g, '')
-          window.reimport = src => {
-            // console.log('Reimporting', src)
-            reimported[sloppy(src)] = true
-            return import('./static/' + src + '#' + i++)
-          }
-          const tracked = {}
-          window.track = src => {
-            if (!tracked[src]) {
-              console.log('Tracking', src)
-              tracked[src] = true;
-              reimport(src)
-            }
-          }
-          try {
-            if (window.track_ws.readyState != websocket.OPEN) {
-              window.track_ws.close()
-            }
-          } catch {}
-          const ws_url = 'ws://' + window.location.host + '/inotify'
-          window.track_ws = new WebSocket(ws_url)
-          window.track_ws.onmessage = msg => {
-            // console.log(sloppy(msg.data), ...Object.keys(reimported))
-            const upd = sloppy(msg.data)
-            if (reimported[upd]) {
-              Object.keys(tracked).forEach(src => {
-                console.log('Reloading', src, 'because', upd, 'was updated')
-                reimport(src)
-              })
-            }
-          }
-        }
-    """
-    text=f"""
-    <html>
-    <head>
-    <script type="module">
-        {track}
-        track({url})
-    </script>
-    </head>
-    <body></body>
-    </html>
-    """
-    return web.Response(text=text, content_type='text/html')
-
-@routes.get('/{track}.js')
-def _track(request):
-    return track(request.match_info.get('track') + '.js')
-
-@routes.get('/')
-def root(request):
-    return track('index.js')
-
-static_dir = os.environ.get('NEPTYNE_DEV_DIR', os.path.dirname(__file__) or '.')
-
-app.add_routes([
-    web.static('/static/', static_dir, show_index=True, append_version=True),
-])
-
-@routes.get('/inotify')
-async def inotify_websocket(request):
-    print('request', request)
-    websocket = web.WebSocketResponse()
-    await websocket.prepare(request)
-
-    watcher = aionotify.Watcher()
-    watcher.watch(path=static_dir, flags=aionotify.Flags.CLOSE_WRITE)
-
-    loop = asyncio.get_event_loop()
-    await watcher.setup(loop)
-    while True:
-        event = await watcher.get_event()
-        # print(event)
-        await websocket.send_str(event.name)
-
-    watcher.close()
-    return websocket
-
-app.router.add_routes(routes)
-
-async def main():
-    import sys
-    if sys.argv[1:2] == ['test']:
+import sys
+
+# The command line. Subcommands import only what they need: kak_source runs
+# on every start of kakoune and request on every request from it, so the
+# web server and the kernel machinery in server.py are only loaded to
+# serve. `neptyne bench startup` keeps an eye on this.
+
+def kak_source():
+    from utils import static_dir
+    with open(os.path.join(static_dir, 'neptyne.kak'), 'r') as f:
+        print(f.read())
+
+
+def sent_path(socket, params):
+    # where the last process request of a buffer of an editor session is
+    # kept, to send the next one as an edit of it
+    import hashlib
+    import tempfile
+    key = '\n'.join([os.path.abspath(socket), str(params.session), str(params.bufname)])
+    dir = os.path.join(tempfile.gettempdir(), f'neptyne-{os.getuid()}')
+    os.makedirs(dir, exist_ok=True)
+    return os.path.join(dir, hashlib.sha1(key.encode()).hexdigest())
+
+
+def request(contents):
+    # a request in the .requests format, to the server of this directory.
+    # A process request goes as an edit of the lines that changed since the
+    # one sent before it for the same buffer, which the server asks the
+    # editor to send in full (args full) when it has another version.
+    import channel
+    from utils import env
+    socket = env('socket', channel.SOCKET) or channel.SOCKET
+    params = channel.parse_request(contents)
+    if params.type != 'process':
+        return replied(channel.send(socket, contents))
+    # kakoune sends in the background, so the requests of a buffer can get
+    # here in any order: they go one at a time, and one that is older than
+    # the one sent before it is left out
+    import fcntl
+    sent = sent_path(socket, params)
+    with open(sent + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(sent) as f:
+                prev = f.read()
+        except FileNotFoundError:
+            prev = None
+        if prev and channel.older(contents, prev):
+            return 0
+        edit = prev and channel.as_edit(contents, prev)
+        code = replied(channel.send(socket, edit or contents))
+        if code:
+            if prev:
+                os.remove(sent)
+            return code
+        with open(sent + '.tmp', 'w') as f:
+            f.write(contents)
+        os.replace(sent + '.tmp', sent)
+    return 0
+
+
+def replied(reply):
+    # the exit code for the reply of the server
+    if reply and not reply['ok']:
+        print(reply['error'], file=sys.stderr)
+        return 1
+    return 0
+
+
+async def main(command):
+    if command == ['test']:
+        import document
         await document.test()
-    elif sys.argv[1:2] == ['kak_source']:
-        print(open(os.path.join(static_dir, 'neptyne.kak'), 'r').read())
+    elif command == ['run']:
+        import batch
+        sys.exit(await batch.main(sys.argv[2:]))
+    elif command == ['bench']:
+        import bench
+        sys.exit(await bench.main(sys.argv[2:]))
     else:
-        connections.append(document.stdout_connection)
-        port = 8234
-        host = '127.0.0.1'
-        args = list(sys.argv[1:])
-        browser = False
-        while len(args) >= 1 and args[0].startswith('-'):
-            two = len(args) >= 2
-            if args[0] == '--browser':
-                browser = True
-                args = args[1:]
-            elif two and args[0].startswith('-p'):
-                port = int(args[1])
-                args = args[2:]
-            elif two and args[0].startswith('-b'):
-                host = args[1]
-                args = args[2:]
-            elif two and args[0].startswith('-h'):
-                print('neptyne [-p PORT] [-b BIND_ADDR] --browser [FILES...]')
-                sys.exit(0)
-            else:
-                raise 'Unknown flag: ' + args[0]
-        if browser:
-            import subprocess
-            subprocess.Popen(f'chromium --app=http://localhost:{port} & disown', shell=True)
-        runner = web.AppRunner(app, access_log_format='%t %a %s %r')
-        await runner.setup()
-        site = web.TCPSite(runner, host, port)
-        await site.start()
-
-        await watch(connections, args)
+        import server
+        await server.main()
 
-        await runner.cleanup()
 
 def sync_main():
-    try:
-        asyncio.run(main())
-    except Exception as e:
-        import traceback as tb
-        tb.print_exc()
-        asyncio.run(document.close_documents())
+    command = sys.argv[1:2]
+    if command == ['kak_source']:
+        kak_source()
+    elif command == ['request']:
+        sys.exit(request(sys.stdin.read()))
+    else:
+        import asyncio
+        try:
+            asyncio.run(main(command))
+        except Exception as e:
+            import traceback as tb
+            tb.print_exc()
+            import document
+            asyncio.run(document.close_documents())
 
 if __name__ == '__main__':
     sync_main()
-
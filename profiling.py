@@ -0,0 +1,60 @@
+# Runs in the kernel with top and min bound. Profiles every cell that is
+# not executed silently with cProfile and, if it took at least min seconds,
+# displays the top functions by own time. Functions of IPython and the
+# kernel itself are left out of the summary.
+PROFILE = '''
+import cProfile, pstats
+from IPython import get_ipython
+from IPython.display import publish_display_data
+
+skip = ('/IPython/', '/ipykernel/', '/traitlets/', '/zmq/', '/tornado/', '/asyncio/', 'cProfile', '<frozen ')
+
+def hotspots(stats):
+    rows = []
+    for (file, line, name), (cc, nc, tt, ct, _) in stats.stats.items():
+        if file != '~' and any(s in file for s in skip):
+            continue
+        rows.append(dict(function=name, file=file, line=line, calls=nc, tottime=tt, cumtime=ct))
+    rows.sort(key=lambda r: -r['tottime'])
+    return rows[:top]
+
+def text(total, rows):
+    lines = [f'profile: {total:.3f}s', f'{"calls":>9} {"tottime":>9} {"cumtime":>9}  function']
+    for r in rows:
+        where = r['function'] if r['file'] == '~' else f"{r['function']} ({r['file'].rsplit('/', 1)[-1]}:{r['line']})"
+        lines.append(f"{r['calls']:>9} {r['tottime']:>9.3f} {r['cumtime']:>9.3f}  {where}")
+    return '\\n'.join(lines)
+
+profiler = None
+
+def pre(*_):
+    global profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+def post(*_):
+    global profiler
+    if profiler is None:
+        return
+    profiler.disable()
+    stats = pstats.Stats(profiler)
+    profiler = None
+    if stats.total_tt >= min:
+        rows = hotspots(stats)
+        publish_display_data({
+            'text/plain': text(stats.total_tt, rows),
+            MIME: dict(total=stats.total_tt, hotspots=rows),
+        })
+
+events = get_ipython().events
+events.register('pre_run_cell', pre)
+events.register('post_run_cell', post)
+'''
+
+# the summaries are display data with this mime type besides text/plain
+MIME = 'application/vnd.neptyne.profile+json'
+
+
+async def install(k, top, min):
+    code = f'exec({PROFILE!r}, {{"top": {top!r}, "min": {min!r}, "MIME": {MIME!r}}})'
+    await k.execute(code, silent=True, store_history=False)
@@ -0,0 +1,463 @@
+from pprint import pprint, pformat
+
+import jupyter_kernel_mgmt as jkm
+
+import asyncio
+import aiohttp
+from aiohttp import web
+
+import os
+import json
+import time
+from collections import deque, Counter, OrderedDict
+
+from utils import *
+
+import channel
+import codec
+import document
+import metrics
+import watcher
+import workers
+from document import Document
+from editor import kak_send
+
+config = dotdict(
+    # states queued per websocket client before the queue collapses to
+    # the latest state per document
+    ws_queue=env('ws_queue', 64),
+    # clients that take longer than this many seconds to accept a message are dropped
+    ws_send_timeout=env('ws_send_timeout', 10.0),
+    # permessage-deflate for clients that offer it
+    ws_compress=env('ws_compress', True),
+    # encoded messages of this many of the latest states are kept for
+    # the other clients that get the same message
+    ws_frames=env('ws_frames', 256),
+    # unix socket for editor requests, next to .requests, empty to only
+    # use .requests
+    socket=env('socket', channel.SOCKET),
+    # documents are sharded over this many worker processes, 0 to keep
+    # them in the server process
+    workers=env('workers', 0),
+    # seconds a file must be left alone after a write before it is read
+    debounce=env('debounce', 0.05),
+)
+
+connections = []
+
+# the worker processes when documents are sharded over them
+shards = None
+
+# the one inotify instance of the server
+files = watcher.Watcher()
+
+requests_total = metrics.Counter('neptyne_requests_total', 'Requests from editors')
+ws_clients = metrics.Gauge('neptyne_websocket_clients', 'Connected websocket clients')
+ws_collapsed = metrics.Counter('neptyne_websocket_collapsed_total', 'Times a websocket client fell behind and its queue was collapsed')
+ws_dropped = metrics.Counter('neptyne_websocket_dropped_total', 'Websocket clients dropped for being too slow')
+encode_seconds = metrics.Histogram('neptyne_encode_seconds', 'Time to encode a patch or snapshot for websocket clients')
+encode_shared = metrics.Counter('neptyne_encode_shared_total', 'Messages to websocket clients that were already encoded for another client')
+subscriber_lag = metrics.Histogram('neptyne_subscriber_lag_seconds', 'Time from a broadcast to its state being sent to a websocket client')
+
+# (id of a state, patch or snapshot, codec) -> (state, encoded message),
+# the state is kept so that its id is not reused while it is here
+frames = OrderedDict()
+
+def encoded(filename, state, type, codec_name):
+    key = id(state), type, codec_name
+    if key in frames:
+        encode_shared.inc()
+        return frames[key][1]
+    if type == 'patch':
+        msg = dotdict(state.patch, type='patch', filename=filename)
+    else:
+        msg = dotdict(type='snapshot', filename=filename, version=state.version, cells=state.all)
+    with metrics.span('encode ' + type, filename=filename, codec=codec_name) as s:
+        data = codec.codecs[codec_name](msg)
+    encode_seconds.observe(s.dur, type=type, codec=codec_name)
+    frames[key] = state, data
+    if len(frames) > config.ws_frames:
+        frames.popitem(last=False)
+    return data
+
+docs = {}
+
+async def doc(filename):
+    if filename not in docs:
+        docs[filename] = await Document(filename, connections)
+    return docs[filename]
+
+async def dispatch(params):
+    # print(pformat(params))
+    version = int(params.timestamp) if 'timestamp' in params else None
+    if params.type == 'process':
+        d = await doc(params.bufname)
+        d.new_body(params.body, version)
+    elif params.type == 'edit':
+        # the body is a json list of [start, end, [line...]]
+        # replacing lines start to end of the version in base
+        d = await doc(params.bufname)
+        try:
+            d.edit(json.loads(params.body), int(params.base), version)
+        except ValueError as e:
+            # made against another version, the editor sends all of it
+            print('Resyncing', params.bufname, repr(e))
+            if params.session:
+                bufname = params.bufname.replace("'", "''")
+                kak_send(f"neptyne-resync '{bufname}'", params)
+    elif params.type in {'restart', 'complete', 'inspect'}:
+        d = await doc(params.bufname)
+        await d[params.type](**params)
+    else:
+        print('Unknown request:', pformat(params))
+
+# patterns: files or globs, ** for any directories, of the documents that
+#           are opened and kept in sync with the files
+# route: where requests go, dispatch for documents in this process
+async def watch(connections, patterns=[], route=dispatch):
+
+    assert not docs, 'Watch already started'
+
+    patterns = [os.path.normpath(p) for p in patterns]
+    initial_files = expand(patterns)
+
+    def process(filename, body):
+        return dotdict(type='process', bufname=filename, body=body)
+
+    if route is dispatch:
+        # start the kernels of all initial files at once rather than one
+        # after the other as each document opens
+        pool = document.kernel_pool()
+        for kernel, n in Counter(map(document.kernel_from_filename, initial_files)).items():
+            pool.warm(kernel, n)
+
+    await files.start()
+    for dir, recursive in {watcher.root(p) for p in patterns}:
+        files.watch(dir, recursive)
+    files.watch('.')
+
+    # requests from the socket, from .requests and for changed files,
+    # handled one at a time in the order they arrive
+    requests = asyncio.Queue()
+
+    async def changed(filename, body):
+        requests.put_nowait(process(filename, body))
+
+    synced = files.subscribe(
+        lambda path: any(watcher.matches(path, p) for p in patterns),
+        changed, debounce=config.debounce, dedupe=True)
+
+    loop = asyncio.get_event_loop()
+    for filename in initial_files:
+        data = await loop.run_in_executor(None, watcher.read_bytes, filename)
+        synced.seen(filename, data)
+        await route(process(filename, data.decode(errors='replace')))
+
+    async def handle_requests():
+        while True:
+            params = await requests.get()
+            requests_total.inc(type=params.type)
+            try:
+                with metrics.span('request ' + str(params.type), bufname=params.bufname, id=params.id):
+                    await route(params)
+            except Exception as e:
+                print('Request failed:', params.get('id'), params.type, repr(e))
+
+    asyncio.create_task(handle_requests())
+
+    if config.socket:
+        await channel.serve(config.socket, requests.put_nowait)
+
+    # every write of .requests is a request, also when it is the same as
+    # the one before
+    async def request(_, text):
+        requests.put_nowait(channel.parse_request(text))
+
+    files.subscribe(lambda path: path == '.requests', request)
+
+    # the requests come in through the subscriptions from now on
+    await asyncio.Event().wait()
+
+app = web.Application()
+routes = web.RouteTableDef()
+
+@routes.get('/ws')
+async def websocket_connection(request):
+    websocket = web.WebSocketResponse(protocols=codec.protocols, compress=config.ws_compress)
+    await websocket.prepare(request)
+    codec_name = codec.negotiated(websocket.ws_protocol)
+    send_frame = websocket.send_bytes if codec_name == 'msgpack' else websocket.send_str
+
+    # states not yet sent to this client, with when they were broadcast.
+    # When it falls behind the queue collapses to the latest state per
+    # document, which it then gets as a snapshot since it has missed patches.
+    q = deque()
+    ready = asyncio.Event()
+
+    async def fwd(filename, state):
+        q.append((filename, state, time.monotonic()))
+        if len(q) > config.ws_queue:
+            latest = {item[0]: item for item in q}
+            q.clear()
+            q.extend(latest.values())
+            ws_collapsed.inc()
+        ready.set()
+
+    # the version of each document this client has, patches are only
+    # sent on top of that and a snapshot is sent otherwise
+    versions = {}
+
+    async def send():
+        while True:
+            await ready.wait()
+            ready.clear()
+            while q:
+                filename, state, t = q.popleft()
+                version = versions.get(filename)
+                if version == state.version:
+                    continue
+                type = 'patch' if state.patch and state.patch.base == version else 'snapshot'
+                data = encoded(filename, state, type, codec_name)
+                try:
+                    await asyncio.wait_for(send_frame(data), config.ws_send_timeout)
+                except (asyncio.TimeoutError, ConnectionError) as e:
+                    print('Dropping websocket client', request.remote, repr(e))
+                    ws_dropped.inc()
+                    await websocket.close()
+                    return
+                subscriber_lag.observe(time.monotonic() - t)
+                versions[filename] = state.version
+
+    connections.append(fwd)
+    ws_clients.inc()
+    sender = asyncio.create_task(send())
+    for _, d in docs.items():
+        d.broadcast()
+
+    try:
+        async for msg in websocket:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                req = dotdict(json.loads(msg.data))
+                if req.type == 'resync':
+                    versions.pop(req.filename, None)
+                    if req.filename in docs:
+                        docs[req.filename].broadcast()
+    finally:
+        connections.remove(fwd)
+        ws_clients.inc(-1)
+        sender.cancel()
+
+    return websocket
+
+@routes.get(r'/outputs/{id:\d+}')
+async def _output(request):
+    # a spilled output, by its id and the filename of its document
+    id = int(request.match_info['id'])
+    if shards:
+        data = await shards.output(request.query.get('filename', ''), id)
+    else:
+        data = document.spilled_output(id)
+    if data is None:
+        raise web.HTTPNotFound()
+    return web.Response(body=data, content_type='application/json')
+
+@routes.get('/blobs/{hash}')
+async def _blob(request):
+    # a large value of a mime bundle, which never changes for its hash
+    hash = request.match_info['hash']
+    headers = {
+        'ETag': f'"{hash}"',
+        'Cache-Control': 'public, max-age=31536000, immutable',
+        'X-Content-Type-Options': 'nosniff',
+    }
+    if headers['ETag'] in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+    loop = asyncio.get_event_loop()
+    blob = await loop.run_in_executor(None, document.blob_store().get, hash)
+    if blob is None:
+        raise web.HTTPNotFound()
+    header, contents = blob
+    content_type = 'application/json' if header.json else header.mime
+    if content_type.startswith('text/') or content_type in {'application/json', 'image/svg+xml'}:
+        content_type += '; charset=utf-8'
+    return web.Response(body=contents, headers=dict(headers, **{'Content-Type': content_type}))
+
+@routes.get('/metrics')
+def _metrics(request):
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+def track(url):
+    url = repr(url)
+    track="""
+        "use strict";
+        {
+          let i = 0
+          const reimported = {}
+          const sloppy = s => s.replace(/.*\//g, '')
+          window.reimport = src => {
+            // console.log('Reimporting', src)
+            reimported[sloppy(src)] = true
+            return import('./static/' + src + '#' + i++)
+          }
+          const tracked = {}
+          window.track = src => {
+            if (!tracked[src]) {
+              console.log('Tracking', src)
+              tracked[src] = true;
+              reimport(src)
+            }
+          }
+          try {
+            if (window.track_ws.readyState != websocket.OPEN) {
+              window.track_ws.close()
+            }
+          } catch {}
+          const ws_url = 'ws://' + window.location.host + '/inotify'
+          window.track_ws = new WebSocket(ws_url)
+          window.track_ws.onmessage = msg => {
+            // console.log(sloppy(msg.data), ...Object.keys(reimported))
+            const upd = sloppy(msg.data)
+            if (reimported[upd]) {
+              Object.keys(tracked).forEach(src => {
+                console.log('Reloading', src, 'because', upd, 'was updated')
+                reimport(src)
+              })
+            }
+          }
+        }
+    """
+    text=f"""
+    <html>
+    <head>
+    <script type="module">
+        {track}
+        track({url})
+    </script>
+    </head>
+    <body></body>
+    </html>
+    """
+    return web.Response(text=text, content_type='text/html')
+
+@routes.get('/{track}.js')
+def _track(request):
+    return track(request.match_info.get('track') + '.js')
+
+@routes.get('/')
+def root(request):
+    return track('index.js')
+
+app.add_routes([
+    web.static('/static/', static_dir, show_index=True, append_version=True),
+])
+
+@routes.get('/inotify')
+async def inotify_websocket(request):
+    print('request', request)
+    websocket = web.WebSocketResponse()
+    await websocket.prepare(request)
+
+    await files.start()
+    files.watch(static_dir)
+    static = os.path.normpath(static_dir)
+
+    async def send(path, _):
+        await websocket.send_str(os.path.basename(path))
+
+    sub = files.subscribe(lambda path: (os.path.dirname(path) or '.') == static, send, debounce=config.debounce, read=False)
+    try:
+        async for _ in websocket:
+            pass
+    finally:
+        sub.close()
+    return websocket
+
+app.router.add_routes(routes)
+
+async def main():
+    # serves, or is one of the workers of a server, as neptyne.py says
+    import sys
+    if sys.argv[1:2] == ['worker']:
+        await workers.serve(dispatch, connections)
+    else:
+        connections.append(document.stdout_connection)
+        port = 8234
+        host = '127.0.0.1'
+        args = list(sys.argv[1:])
+        browser = False
+        while len(args) >= 1 and args[0].startswith('-'):
+            two = len(args) >= 2
+            if args[0] == '--browser':
+                browser = True
+                args = args[1:]
+            elif two and args[0].startswith('-p'):
+                port = int(args[1])
+                args = args[2:]
+            elif two and args[0].startswith('-b'):
+                host = args[1]
+                args = args[2:]
+            elif args[0] == '--deps':
+                document.config.deps = True
+                args = args[1:]
+            elif args[0] == '--checkpoint':
+                document.config.checkpoint = True
+                args = args[1:]
+            elif args[0] == '--profile':
+                document.config.profile = True
+                args = args[1:]
+            elif args[0] == '--no-fallback':
+                document.config.fallback = False
+                args = args[1:]
+            elif args[0] == '--output-cache':
+                document.config.output_cache = True
+                args = args[1:]
+            elif two and args[0] == '--stream-window':
+                document.config.stream_window = float(args[1])
+                args = args[2:]
+            elif two and args[0] == '--broadcast-rate':
+                document.config.broadcast_rate = float(args[1])
+                args = args[2:]
+            elif two and args[0] == '--kernel':
+                pattern, name = args[1].rsplit('=', 1)
+                document.config.kernels.append((pattern, name))
+                args = args[2:]
+            elif two and args[0] == '--ext':
+                ext, lang = args[1].split('=', 1)
+                document.config.kernel_exts[ext.lstrip('.').lower()] = lang
+                args = args[2:]
+            elif two and args[0] == '--workers':
+                config.workers = int(args[1])
+                args = args[2:]
+            elif two and args[0] == '--socket':
+                config.socket = args[1]
+                args = args[2:]
+            elif two and args[0] == '--trace':
+                metrics.config.trace = args[1]
+                args = args[2:]
+            elif two and args[0] == '--kernel-pool':
+                document.config.kernel_pool = int(args[1])
+                args = args[2:]
+            elif two and args[0].startswith('-h'):
+                print('neptyne [-p PORT] [-b BIND_ADDR] [--deps] [--checkpoint] [--profile] [--output-cache] [--no-fallback] [--stream-window SECONDS] [--broadcast-rate PER_SECOND] [--kernel-pool N] [--kernel PATTERN=KERNEL] [--ext EXT=LANGUAGE] [--socket PATH] [--workers N] [--trace FILE] --browser [FILES...]')
+                sys.exit(0)
+            else:
+                raise 'Unknown flag: ' + args[0]
+        if browser:
+            import subprocess
+            subprocess.Popen(f'chromium --app=http://localhost:{port} & disown', shell=True)
+        runner = web.AppRunner(app, access_log_format='%t %a %s %r')
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+
+        if config.workers:
+            global shards
+            shards = workers.Workers(config.workers, connections, docs)
+            await shards.start()
+            await watch(connections, args, shards.route)
+        else:
+            await watch(connections, args)
+
+        await runner.cleanup()
@@ -0,0 +1,59 @@
+import os
+import mmap
+import tempfile
+
+from utils import *
+
+
+class SpillStore:
+    # Outputs moved out of memory, appended to unlinked temporary files in
+    # dir and read back through a memory map. When the current file has
+    # grown to half of max_bytes a new one is started and the one before it
+    # is dropped, so at most about max_bytes are on disk and the outputs
+    # spilled before that are gone.
+
+    def __init__(self, dir, max_bytes):
+        os.makedirs(dir, exist_ok=True)
+        self.dir = dir
+        self.max_bytes = max_bytes
+        self.files = []
+        self.rotate()
+
+    def rotate(self):
+        if len(self.files) == 2:
+            old = self.files.pop(0)
+            if old.map:
+                old.map.close()
+            old.f.close()
+        f = tempfile.TemporaryFile(dir=self.dir, prefix='spill-')
+        self.files.append(dotdict(f=f, index={}, size=0, map=None))
+
+    def put(self, id, data):
+        cur = self.files[-1]
+        if cur.size and cur.size + len(data) > self.max_bytes // 2:
+            self.rotate()
+            cur = self.files[-1]
+        cur.f.seek(cur.size)
+        cur.f.write(data)
+        cur.index[id] = (cur.size, len(data))
+        cur.size += len(data)
+
+    def get(self, id):
+        for s in reversed(self.files):
+            if id in s.index:
+                offset, n = s.index[id]
+                if s.map is None or len(s.map) < offset + n:
+                    # the file has grown since it was mapped
+                    s.f.flush()
+                    if s.map:
+                        s.map.close()
+                    s.map = mmap.mmap(s.f.fileno(), 0, access=mmap.ACCESS_READ)
+                return s.map[offset:offset + n]
+        return None
+
+    def close(self):
+        while self.files:
+            s = self.files.pop()
+            if s.map:
+                s.map.close()
+            s.f.close()
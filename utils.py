@@ -1,3 +1,7 @@
+import os
+import glob
+
+
 class dotdict(dict):
     __getattr__ = dict.get
     __setattr__ = dict.__setitem__
@@ -18,6 +22,33 @@ def id_stream(prevs=()):
     return bump
 
 
+def env(name, default):
+    # NEPTYNE_<NAME> from the environment, parsed like the default
+    v = os.environ.get('NEPTYNE_' + name.upper())
+    if v is None:
+        return default
+    if isinstance(default, bool):
+        return v.lower() not in {'', '0', 'false', 'no'}
+    if default is None:
+        return v
+    return type(default)(v)
+
+
+def expand(patterns):
+    # the files of the patterns, globs with ** for any directories, in order
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        for f in matches:
+            if f not in files:
+                files.append(f)
+    return files
+
+
+# the files served to browsers and editors, NEPTYNE_DEV_DIR to use others
+static_dir = os.environ.get('NEPTYNE_DEV_DIR', os.path.dirname(__file__) or '.')
+
+
 def traverseKVs(d, f):
     if isinstance(d, dict):
         return type(d)(
@@ -0,0 +1,182 @@
+import os
+import glob
+import asyncio
+import hashlib
+from fnmatch import fnmatch
+
+import aionotify
+
+from utils import *
+
+# One inotify instance for all the directories the process watches, which
+# hands the files that change to the subscriptions that match them. A
+# subscription waits for a quiet period per path, so that the bursts of
+# writes some editors make on save become one change, reads the files off
+# the event loop and can skip files whose contents have not changed since
+# it last got them. Changes reach a subscription in the order they settle.
+
+FLAGS = aionotify.Flags.CLOSE_WRITE | aionotify.Flags.MOVED_TO | aionotify.Flags.CREATE
+
+# directories that are not watched recursively, besides hidden ones
+SKIP_DIRS = {'__pycache__', 'node_modules'}
+
+
+def matches(path, pattern):
+    # whether glob.glob(pattern, recursive=True) would find path: * and ?
+    # stay within a directory, ** is any number of directories
+    return match_parts(path.split('/'), pattern.split('/'))
+
+
+def match_parts(parts, pats):
+    if not pats:
+        return not parts
+    if pats[0] == '**':
+        return any(match_parts(parts[i:], pats[1:]) for i in range(len(parts) + 1))
+    return bool(parts) and fnmatch(parts[0], pats[0]) and match_parts(parts[1:], pats[1:])
+
+
+def root(pattern):
+    # the directory to watch for a pattern, and whether its subdirectories
+    # are needed too
+    parts = pattern.split('/')
+    fixed = []
+    for part in parts[:-1]:
+        if glob.has_magic(part):
+            break
+        fixed.append(part)
+    dir = '/'.join(fixed) or ('/' if fixed else '.')
+    return dir, len(fixed) < len(parts) - 1
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class Subscription:
+    def __init__(self, watcher, match, callback, debounce, dedupe, read):
+        self.watcher = watcher
+        self.match = match
+        self.callback = callback
+        self.debounce = debounce
+        self.dedupe = dedupe
+        self.read = read
+        self.timers = {}
+        self.hashes = {}
+        self.settled = asyncio.Queue()
+        self.task = asyncio.create_task(self.deliver())
+
+    def changed(self, path):
+        timer = self.timers.pop(path, None)
+        if timer:
+            timer.cancel()
+        if self.debounce:
+            loop = asyncio.get_event_loop()
+            self.timers[path] = loop.call_later(self.debounce, self.settle, path)
+        else:
+            self.settle(path)
+
+    def settle(self, path):
+        self.timers.pop(path, None)
+        self.settled.put_nowait(path)
+
+    def seen(self, path, data):
+        # data is what the subscriber already has of path
+        self.hashes[path] = hashlib.sha1(data).digest()
+
+    async def deliver(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            path = await self.settled.get()
+            text = None
+            if self.read:
+                try:
+                    data = await loop.run_in_executor(None, read_bytes, path)
+                except OSError:
+                    continue
+                if self.dedupe:
+                    h = hashlib.sha1(data).digest()
+                    if self.hashes.get(path) == h:
+                        continue
+                    self.hashes[path] = h
+                text = data.decode(errors='replace')
+            try:
+                await self.callback(path, text)
+            except Exception as e:
+                print('Watcher subscriber failed on', path, repr(e))
+
+    def close(self):
+        if self in self.watcher.subs:
+            self.watcher.subs.remove(self)
+        for timer in self.timers.values():
+            timer.cancel()
+        self.task.cancel()
+
+
+class Watcher:
+    def __init__(self):
+        self.inotify = aionotify.Watcher()
+        self.started = False
+        # alias of an inotify watch -> its directory, aliases are never
+        # reused since a removed directory can come back
+        self.dirs = {}
+        # directory -> whether its new subdirectories are watched too
+        self.watched = {}
+        self.subs = []
+
+    async def start(self):
+        if not self.started:
+            self.started = True
+            await self.inotify.setup(asyncio.get_event_loop())
+            asyncio.create_task(self.run())
+
+    def watch(self, dir, recursive=False):
+        dir = os.path.normpath(dir)
+        if dir in self.watched:
+            if not recursive or self.watched[dir]:
+                return
+            self.watched[dir] = True
+        else:
+            self.watched[dir] = recursive
+            alias = str(len(self.dirs))
+            self.dirs[alias] = dir
+            self.inotify.watch(path=dir, flags=FLAGS, alias=alias)
+        if recursive:
+            for entry in os.scandir(dir):
+                if entry.is_dir() and self.wanted(entry.name):
+                    self.watch(entry.path, True)
+
+    def wanted(self, name):
+        return not name.startswith('.') and name not in SKIP_DIRS
+
+    def subscribe(self, match, callback, debounce=0.0, dedupe=False, read=True):
+        # callback(path, text) for the paths for which match(path) holds,
+        # text is None unless read
+        sub = Subscription(self, match, callback, debounce, dedupe, read)
+        self.subs.append(sub)
+        return sub
+
+    async def run(self):
+        while True:
+            event = await self.inotify.get_event()
+            if event is None:
+                return
+            dir = self.dirs[event.alias]
+            if event.flags & aionotify.Flags.IGNORED:
+                # the directory is gone
+                self.watched.pop(dir, None)
+                continue
+            path = os.path.normpath(os.path.join(dir, event.name))
+            if event.flags & aionotify.Flags.ISDIR:
+                if self.watched.get(dir) and self.wanted(event.name):
+                    try:
+                        self.watch(path, True)
+                    except (OSError, IOError):
+                        pass
+                continue
+            if event.flags & aionotify.Flags.CREATE:
+                # the contents come with its CLOSE_WRITE
+                continue
+            for sub in list(self.subs):
+                if sub.match(path):
+                    sub.changed(path)
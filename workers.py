@@ -0,0 +1,265 @@
+import asyncio
+import json
+import os
+import sys
+import zlib
+from asyncio.subprocess import PIPE
+
+from utils import *
+
+import document
+import metrics
+from body import Body
+from document import Msgs, to_json
+from channel import frame, read_frame
+
+# Documents sharded over worker processes. The front process sends each
+# worker the requests for its documents and gets back the patches of their
+# states, which it applies to mirrors of the documents and hands to its
+# connections as if the documents were its own. Frames are json with the
+# framing of channel.py, over the stdin and stdout of the workers. A worker
+# that exits is started again, and reopens the documents of its shard from
+# the bodies the front process keeps of them.
+
+NEPTYNE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'neptyne.py')
+
+
+def encode(obj):
+    return frame(json.dumps(obj, default=to_json).encode())
+
+
+async def decode(reader):
+    return json.loads(await read_frame(reader), object_hook=dotdict)
+
+
+class Mirror:
+    # The cells of a document in a worker, rebuilt from its patches. Like
+    # the cell snapshots in the worker they are not changed once made, so
+    # that states queued for slow subscribers stay as they were.
+
+    def __init__(self):
+        self.version = 0
+        self.order = []
+        self.cells = {}
+        self.state = None
+        # added to the versions of the worker, which start over when a new
+        # worker opens the document again
+        self.offset = 0
+
+    def apply(self, patch, running):
+        if not patch.base:
+            # the first patch of a document, also of one a new worker has
+            # opened again. Its versions go on past those of the old worker,
+            # so that no subscriber gets it on top of cells that are gone.
+            self.cells = {}
+            self.offset = self.version + 1 if self.version else 0
+        patch = dotdict(patch, base=patch.base + self.offset, version=patch.version + self.offset)
+        for id in patch.remove:
+            self.cells.pop(id, None)
+        for c in patch.add:
+            self.cells[c.id] = dotdict(
+                c,
+                msgs=Msgs(list(c.msgs or [])),
+                prev_msgs=None if c.prev_msgs is None else Msgs(list(c.prev_msgs)))
+        for u in patch.changed:
+            c = self.cells[u.id]
+            msgs, prev_msgs = c.msgs, c.prev_msgs
+            if 'msgs' in u:
+                msgs = Msgs(list(u.msgs or []))
+            if 'append' in u:
+                msgs.buf.extend(u.append)
+                msgs = Msgs(msgs.buf)
+            if 'prev_msgs' in u:
+                prev_msgs = None if u.prev_msgs is None else Msgs(list(u.prev_msgs))
+            self.cells[u.id] = dotdict(
+                c,
+                status=u.get('status', c.status),
+                msgs=msgs,
+                prev_msgs=prev_msgs,
+                timing=u.get('timing', c.timing))
+        if 'order' in patch:
+            self.order = patch.order
+        self.version = patch.version
+        self.state = dotdict(
+            running=running,
+            version=self.version,
+            all=[self.cells[id] for id in self.order],
+            patch=patch)
+        return self.state
+
+
+class Workers:
+    # The front side: starts the workers, routes requests to the worker of
+    # their document and fans out what comes back.
+
+    def __init__(self, n, connections, docs):
+        self.n = n
+        self.connections = connections
+        self.docs = docs
+        self.procs = []
+        self.mirrors = {}
+        # filename -> Body, as the requests routed so far leave it
+        self.bodies = {}
+        # spilled outputs asked for by id, answered by the workers:
+        # ask -> (worker, future)
+        self.asked = {}
+        self.next_ask = 0
+        self.closing = False
+
+    async def start(self):
+        for i in range(self.n):
+            self.procs.append(await self.spawn(i))
+
+    async def spawn(self, i):
+        p = await asyncio.create_subprocess_exec(sys.executable, NEPTYNE, 'worker', stdin=PIPE, stdout=PIPE)
+        p.stdin.write(encode(dict(op='config', config=document.config, metrics=metrics.config)))
+        asyncio.create_task(self.read(i, p))
+        return p
+
+    async def restart(self, i):
+        # a new worker in place of worker i, which opens its documents again
+        # with the bodies they had. Their mirrors go on with later versions,
+        # so their subscribers get snapshots.
+        await asyncio.sleep(1)
+        p = self.procs[i] = await self.spawn(i)
+        for filename, body in self.bodies.items():
+            if self.shard(filename) is p:
+                params = dotdict(type='process', bufname=filename, body=body.text())
+                if body.version is not None:
+                    params.timestamp = body.version
+                p.stdin.write(encode(dict(op='request', params=params)))
+        await p.stdin.drain()
+
+    def shard(self, filename):
+        return self.procs[zlib.crc32(filename.encode()) % self.n]
+
+    def track(self, params):
+        # keeps the body of the document of a request as its worker will
+        # have it, as _Document.new_body and edit change theirs
+        body = self.bodies.setdefault(params.bufname, Body())
+        version = int(params.timestamp) if 'timestamp' in params else None
+        try:
+            if params.type == 'process':
+                if body.replace(params.body) or version is not None:
+                    body.version = version
+            elif params.type == 'edit' and int(params.base) == body.version:
+                for start, end, lines in json.loads(params.body):
+                    body.edit(start, end, lines)
+                body.version = body.version + 1 if version is None else version
+        except Exception as e:
+            print('Not keeping the body of', params.bufname, repr(e))
+            del self.bodies[params.bufname]
+
+    async def route(self, params):
+        if params.type in {'process', 'edit'}:
+            self.track(params)
+        p = self.shard(params.bufname)
+        if p.returncode is not None:
+            # the worker is being restarted and gets the body then
+            return
+        try:
+            p.stdin.write(encode(dict(op='request', params=params)))
+            await p.stdin.drain()
+        except ConnectionError:
+            pass
+
+    async def output(self, filename, id):
+        # the json of a spilled output of a document, None if it is gone
+        p = self.shard(filename)
+        if p.returncode is not None:
+            return None
+        self.next_ask += 1
+        ask = self.next_ask
+        future = asyncio.get_event_loop().create_future()
+        self.asked[ask] = p, future
+        try:
+            p.stdin.write(encode(dict(op='output', ask=ask, id=id)))
+            await p.stdin.drain()
+            return await future
+        except ConnectionError:
+            return None
+        finally:
+            del self.asked[ask]
+
+    async def read(self, i, p):
+        while True:
+            try:
+                msg = await decode(p.stdout)
+            except asyncio.IncompleteReadError:
+                print('Worker', i, 'has exited with', await p.wait())
+                for asker, future in self.asked.values():
+                    if asker is p and not future.done():
+                        future.set_result(None)
+                if not self.closing:
+                    await self.restart(i)
+                return
+            if msg.op == 'output':
+                if msg.ask in self.asked:
+                    self.asked[msg.ask][1].set_result(msg.data and msg.data.encode())
+                continue
+            mirror = self.mirrors.setdefault(msg.filename, Mirror())
+            state = mirror.apply(msg.patch, msg.running)
+            if msg.filename not in self.docs:
+                self.docs[msg.filename] = dotdict(broadcast=self.rebroadcast(msg.filename))
+            await self.fan_out(msg.filename, state)
+
+    async def fan_out(self, filename, state):
+        for c in list(self.connections):
+            await c(filename, state)
+
+    def rebroadcast(self, filename):
+        def broadcast():
+            state = self.mirrors[filename].state
+            asyncio.create_task(self.fan_out(filename, state))
+        return broadcast
+
+    async def close(self):
+        self.closing = True
+        for p in self.procs:
+            p.stdin.close()
+        for p in self.procs:
+            await p.wait()
+
+
+async def serve(dispatch, connections):
+    # The worker side: requests come in on stdin and patches go out on
+    # stdout. Anything printed, also by kernels, goes to stderr instead.
+    loop = asyncio.get_event_loop()
+    out = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, out)
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    async def send(filename, state):
+        if state.patch:
+            writer.write(encode(dict(filename=filename, running=state.running, patch=state.patch)))
+            await writer.drain()
+
+    connections.append(send)
+
+    try:
+        while True:
+            try:
+                msg = await decode(reader)
+            except asyncio.IncompleteReadError:
+                return
+            if msg.op == 'config':
+                document.config.update(msg.config)
+                metrics.config.update(msg.metrics or {})
+                if metrics.config.trace:
+                    # each worker writes its own spans
+                    metrics.config.trace += f'.{os.getpid()}'
+            elif msg.op == 'output':
+                data = document.spilled_output(msg.id)
+                writer.write(encode(dict(op='output', ask=msg.ask, data=data and data.decode())))
+                await writer.drain()
+            elif msg.op == 'request':
+                try:
+                    await dispatch(msg.params)
+                except Exception as e:
+                    print('Request failed:', msg.params.get('id'), msg.params.type, repr(e))
+    finally:
+        await document.close_documents()